@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+import json
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def job_key(job) -> str:
+    '''Checkpoint key of a job, a new head SHA makes it a new job'''
+    key = f"{job['repo']}#{job['number']}"
+    return f"{key}@{job['head_sha']}" if job.get("head_sha") else key
+
+
+def parse_job(line):
+    '''Parse a {"repo": "owner/name", "number": 1, "head_sha": optional} job line, None for blank lines'''
+    line = line.strip()
+    if not line:
+        return None
+    job = json.loads(line)
+    if not isinstance(job, dict):
+        raise ValueError("a job must be a JSON object")
+    number = job.get("number")
+    if not isinstance(job.get("repo"), str) or not isinstance(number, int) or isinstance(number, bool):
+        raise ValueError("a job needs a repo name and a pull request number")
+    return job
+
+
+class JobQueue:
+    '''Pending jobs, handed out round-robin across repositories so none starves the others'''
+
+    def __init__(self):
+        self.queues = OrderedDict()
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def add(self, job):
+        self.queues.setdefault(job["repo"], deque()).append(job)
+
+    def pop(self):
+        '''Next job of the repository whose turn it is, None when there are no jobs'''
+        if not self.queues:
+            return None
+        repo, queue = next(iter(self.queues.items()))
+        job = queue.popleft()
+        # the repository goes to the back of the rotation, or leaves it when drained
+        del self.queues[repo]
+        if queue:
+            self.queues[repo] = queue
+        return job
+
+
+class Checkpoint:
+    '''Append-only record of the completed jobs, so a restarted batch skips them'''
+
+    def __init__(self, path=""):
+        self.path = path
+        self.done = set()
+        self.lock = threading.Lock()
+        # a line cut short is ended before appending, so the next record is not lost with it
+        self.truncated = False
+        if not path:
+            return
+        try:
+            with open(path, encoding="utf-8") as f:
+                for number, line in enumerate(f, 1):
+                    self.truncated = not line.endswith("\n")
+                    if not line.strip():
+                        continue
+                    try:
+                        self.done.add(json.loads(line)["job"])
+                    except (ValueError, KeyError, TypeError) as e:
+                        # the last line is cut short when the batch is killed while appending it
+                        print(f"Skipping checkpoint line {number} with error: {e}")
+        except FileNotFoundError:
+            pass
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.done
+
+    def add(self, key):
+        with self.lock:
+            self.done.add(key)
+            if self.path:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(("\n" if self.truncated else "") + json.dumps({"job": key}) + "\n")
+                self.truncated = False
+
+
+class BatchReviewer:
+    '''Review a stream of (repository, pull request) jobs with one set of warmed up clients.
+
+    Jobs are read as they arrive, so the input can be a file or a pipe that
+    stays open. At most concurrency pull requests are reviewed at a time,
+    each with the file workers of the GithubClient.
+    '''
+
+    def __init__(self, github_client, concurrency=4, checkpoint_path=""):
+        self.github_client = github_client
+        self.concurrency = max(1, concurrency)
+        self.checkpoint = Checkpoint(checkpoint_path)
+        self.queue = JobQueue()
+        self.queued = set()
+        self.running = 0
+        self.reading = True
+        self.reviewed = 0
+        self.failed = 0
+        self.condition = threading.Condition()
+
+    def read_jobs(self, lines):
+        '''Queue the jobs of lines, skipping those already done or queued'''
+        try:
+            for number, line in enumerate(lines, 1):
+                try:
+                    job = parse_job(line)
+                except ValueError as e:
+                    print(f"Skipping job line {number} with error: {e}")
+                    continue
+                if job is None:
+                    continue
+                key = job_key(job)
+                with self.condition:
+                    if key in self.queued or key in self.checkpoint:
+                        continue
+                    self.queued.add(key)
+                    self.queue.add(job)
+                    self.condition.notify_all()
+        finally:
+            with self.condition:
+                self.reading = False
+                self.condition.notify_all()
+
+    def review(self, job):
+        key = job_key(job)
+        print(f"Reviewing {key}")
+        payload = {"number": job["number"]}
+        if job.get("head_sha"):
+            payload["pull_request"] = {"head": {"sha": job["head_sha"]}}
+        try:
+            self.github_client.review(self.github_client.get_pull_request(payload, job["repo"]))
+            self.checkpoint.add(key)
+            with self.condition:
+                self.reviewed += 1
+        except Exception as e:
+            print(f"Failed {key} with error: {e}")
+            with self.condition:
+                self.failed += 1
+        finally:
+            with self.condition:
+                self.running -= 1
+                self.queued.discard(key)
+                self.condition.notify_all()
+
+    def run(self, lines):
+        '''Review the jobs of lines until the input ends and every job is finished'''
+        reader = threading.Thread(target=self.read_jobs, args=(lines,), daemon=True)
+        reader.start()
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                while True:
+                    with self.condition:
+                        while not (self.queue and self.running < self.concurrency) and \
+                                (self.reading or self.queue or self.running):
+                            self.condition.wait()
+                        job = self.queue.pop()
+                        if job is None:
+                            break
+                        self.running += 1
+                    executor.submit(self.review, job)
+        finally:
+            self.github_client.write_report()
+        print(f"Reviewed {self.reviewed} pull requests, {self.failed} failed")
@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+from contextlib import nullcontext
+
+
+HUNK_HEADER_PREFIX = "@@"
+
+
+class TokenBudget:
+    '''Token counts of the lines of a diff or file, against a budget of max_tokens.
+
+    encoder is anything with an encode() method returning the tokens. With
+    metrics, each count_lines() call is timed as one tokenization.
+    '''
+
+    def __init__(self, encoder, max_tokens, metrics=None):
+        self.encoder = encoder
+        self.max_tokens = max_tokens
+        self.metrics = metrics
+
+    def count_lines(self, lines) -> list:
+        '''Token count of each line, including its trailing newline'''
+        encode = self.encoder.encode
+        with self.metrics.stage("tokenization") if self.metrics is not None else nullcontext():
+            return [len(encode(f'{line}\n')) for line in lines]
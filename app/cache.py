@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def content_hash(*parts) -> str:
+    '''Stable hash of the given parts'''
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class CacheBackend:
+    '''Storage for cached completions. The base backend stores nothing.'''
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend(CacheBackend):
+    '''SQLite store bounded to max_bytes, evicting the least recently used entries.
+
+    The database is a single file, so it can be saved and restored between
+    workflow runs with actions/cache.
+    '''
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS completions ("
+                        "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                        "size INTEGER NOT NULL, accessed REAL NOT NULL)")
+        self.db.commit()
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.db.execute("UPDATE completions SET accessed = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+            return row[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)",
+                            (key, value, len(value.encode("utf-8")), time.time()))
+            self.evict()
+            self.db.commit()
+
+    def evict(self):
+        '''Drop the least recently used entries until the store fits max_bytes'''
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in self.db.execute("SELECT key, size FROM completions ORDER BY accessed"):
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        self.db.executemany("DELETE FROM completions WHERE key = ?", evicted)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class CompletionCache:
+    '''Content-addressed cache of completion results'''
+
+    def __init__(self, backend=None):
+        self.backend = backend or CacheBackend()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, content_sha, template, model, temperature) -> str:
+        '''Key on the reviewed content, the prompt template and the model settings'''
+        return content_hash(content_sha, content_hash(template), model, temperature)
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(value)
+
+    def set(self, key, value):
+        self.backend.set(key, json.dumps(value))
+
+
+def open_cache(path, max_bytes) -> CompletionCache:
+    '''Open the completion cache at path, or a disabled cache if path is empty'''
+    if not path:
+        return CompletionCache()
+    return CompletionCache(SQLiteBackend(path, max_bytes))
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+import re
+from budget import HUNK_HEADER_PREFIX
+
+
+HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,\d+)? \+(\d+)(?:,\d+)? @@(.*)$")
+
+
+def is_block_start(line) -> bool:
+    '''Whether a line starts a top-level block (function, class, ...) in most languages'''
+    return bool(line[:1].strip()) and not line.startswith(("}", ")", "]", "#", "//", "/*", "*"))
+
+
+class Chunk:
+    '''A token-bounded piece of a file, covering lines [start_line, end_line] of it'''
+
+    def __init__(self, text, start_line, end_line, tokens=0):
+        self.text = text
+        self.start_line = start_line
+        self.end_line = end_line
+        self.tokens = tokens
+
+
+class Chunker:
+    '''Split diffs and file contents into token-bounded chunks on hunk/block boundaries'''
+
+    def __init__(self, token_budget, context_lines=3):
+        self.token_budget = token_budget
+        self.context_lines = context_lines
+
+    def pack(self, lines, counts, max_tokens, is_boundary) -> list:
+        '''Greedily cut lines into (start, end) ranges of at most max_tokens.
+
+        A range that overflows is cut before the overflowing line if that is a
+        boundary, else back to the last boundary inside it, else at the
+        overflowing line.
+        '''
+        ranges = []
+        start, total, boundary = 0, 0, None
+        i = 0
+        while i < len(lines):
+            if total + counts[i] > max_tokens and i > start:
+                end = i if is_boundary(lines[i]) or boundary is None else boundary
+                ranges.append((start, end))
+                start, total, boundary = end, 0, None
+                i = start
+                continue
+            if i > start and is_boundary(lines[i]):
+                boundary = i
+            total += counts[i]
+            i += 1
+        if start < len(lines):
+            ranges.append((start, len(lines)))
+        return ranges
+
+    def split_hunk(self, hunk, counts, max_tokens) -> list:
+        '''Split one oversized hunk into smaller hunks with their own headers'''
+        match = HUNK_HEADER.match(hunk[0])
+        old_line, new_line, section = int(match.group(1)), int(match.group(2)), match.group(3)
+        body, body_counts = hunk[1:], counts[1:]
+
+        def is_boundary(line):
+            return line[:1] in (" ", "+", "-") and is_block_start(line[1:])
+
+        hunks = []
+        # leave room for the rewritten header
+        for start, end in self.pack(body, body_counts, max_tokens - counts[0], is_boundary):
+            lines = body[start:end]
+            old_count = sum(1 for line in lines if line[:1] in (" ", "-"))
+            new_count = sum(1 for line in lines if line[:1] in (" ", "+"))
+            header = f"@@ -{old_line},{old_count} +{new_line},{new_count} @@{section}"
+            hunks.append(([header] + lines, [counts[0]] + body_counts[start:end], new_line, new_count))
+            old_line += old_count
+            new_line += new_count
+        return hunks
+
+    def split_patch(self, patch, max_tokens) -> list:
+        '''Split a file patch into chunks of whole hunks, each with the patch header'''
+        lines = patch.splitlines()
+        counts = self.token_budget.count_lines(lines)
+        first = next((i for i, line in enumerate(lines) if line.startswith(HUNK_HEADER_PREFIX)), len(lines))
+        header, header_tokens = lines[:first], sum(counts[:first])
+        budget = max_tokens - header_tokens
+
+        # hunks as (lines, counts, first new line, new line count)
+        hunks = []
+        starts = [i for i in range(first, len(lines)) if lines[i].startswith(HUNK_HEADER_PREFIX)]
+        for start, end in zip(starts, starts[1:] + [len(lines)]):
+            hunk, hunk_counts = lines[start:end], counts[start:end]
+            match = HUNK_HEADER.match(hunk[0])
+            if sum(hunk_counts) > budget and match is not None:
+                hunks.extend(self.split_hunk(hunk, hunk_counts, budget))
+                continue
+            new_line = int(match.group(2)) if match else 1
+            new_count = sum(1 for line in hunk[1:] if line[:1] in (" ", "+"))
+            hunks.append((hunk, hunk_counts, new_line, new_count))
+
+        if not hunks:
+            return [Chunk(patch, 1, 1, sum(counts))] if patch else []
+
+        chunks = []
+        hunk_tokens = [sum(hunk_counts) for _, hunk_counts, _, _ in hunks]
+        for start, end in self.pack(hunks, hunk_tokens, budget, lambda hunk: True):
+            text = '\n'.join(header + [line for hunk in hunks[start:end] for line in hunk[0]])
+            first_line = hunks[start][2]
+            last_line = hunks[end - 1][2] + max(hunks[end - 1][3], 1) - 1
+            chunks.append(Chunk(text, first_line, last_line, header_tokens + sum(hunk_tokens[start:end])))
+        return chunks
+
+    def split_contents(self, contents, max_tokens) -> list:
+        '''Split file contents into chunks of numbered lines on top-level blocks, with a few lines of leading context'''
+        lines = contents.splitlines()
+        if not lines:
+            return []
+        numbered = [f"{number}: {line}" for number, line in enumerate(lines, 1)]
+        counts = self.token_budget.count_lines(numbered)
+        chunks = []
+        for start, end in self.pack(lines, counts, max_tokens, is_block_start):
+            total = sum(counts[start:end])
+            context = start
+            while context > 0 and start - context < self.context_lines and total + counts[context - 1] <= max_tokens:
+                context -= 1
+                total += counts[context]
+            chunks.append(Chunk('\n'.join(numbered[context:end]), context + 1, end, total))
+        return chunks
+
+    def split_excerpts(self, lines, ranges, max_tokens) -> list:
+        '''Render (start, end) line ranges of a file as excerpts with numbered lines, in chunks of max_tokens'''
+        # (numbered line, line number, whether it starts an excerpt)
+        excerpts = [(f"{number}: {lines[number - 1]}", number, number == start)
+                    for start, end in ranges for number in range(start, end + 1)]
+        counts = self.token_budget.count_lines([text for text, _, _ in excerpts])
+
+        def is_boundary(item):
+            return item[2] or is_block_start(lines[item[1] - 1])
+
+        chunks = []
+        for start, end in self.pack(excerpts, counts, max_tokens, is_boundary):
+            text = []
+            for i, (line, _, first) in enumerate(excerpts[start:end]):
+                if first and i > 0:
+                    text.append("...")
+                text.append(line)
+            chunks.append(Chunk('\n'.join(text), excerpts[start][1], excerpts[end - 1][1], sum(counts[start:end])))
+        return chunks
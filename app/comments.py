@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+import re
+
+
+HUNK_HEADER = re.compile(r"^@@ -\d+(?:,\d+)? \+(\d+)(?:,\d+)? @@")
+
+
+def diff_positions(patch) -> dict:
+    '''Map new-file line numbers to their position in a file's patch.
+
+    The position is what the reviews API expects: the line right below the
+    first hunk header is position 1, and it keeps counting through later hunk
+    headers until the end of the file's patch.
+    '''
+    positions = {}
+    if not patch:
+        return positions
+
+    position = 0
+    new_line = None
+    for text in patch.splitlines():
+        header = HUNK_HEADER.match(text)
+        if new_line is not None:
+            position += 1
+        if header:
+            new_line = int(header.group(1))
+            continue
+        if new_line is None or text.startswith("-") or text.startswith("\\"):
+            continue
+        positions[new_line] = position
+        new_line += 1
+    return positions
+
+
+class ReviewComments:
+    '''Collects the findings of a run so they can be posted as one review'''
+
+    def __init__(self):
+        self.positions = {}
+        self.comments = []
+        self.file_comments = {}
+        self.total_severity = 0
+
+    def add_file(self, path, patch):
+        '''Register the patch findings on path are anchored to'''
+        if path not in self.positions:
+            self.positions[path] = diff_positions(patch)
+
+    def add(self, path, severity, line, body):
+        '''Add a finding, anchored to its diff position when the line is in the patch'''
+        self.total_severity += severity
+        content = f"Severity: {severity}\nLine: {line}\n\n{body}"
+        position = self.positions.get(path, {}).get(line)
+        if position is None:
+            self.file_comments.setdefault(path, []).append(content)
+            return
+        self.comments.append({
+            "path": path,
+            "position": position,
+            "body": content,
+        })
+
+    def __len__(self):
+        return len(self.comments) + sum(len(c) for c in self.file_comments.values())
+
+    def review_body(self, summary, inline=False) -> str:
+        '''Review body with the findings that could not be anchored to a line, and the anchored ones too if inline'''
+        file_comments = {path: list(contents) for path, contents in self.file_comments.items()}
+        if inline:
+            for comment in self.comments:
+                file_comments.setdefault(comment["path"], []).append(comment["body"])
+        sections = [summary]
+        for path, contents in file_comments.items():
+            sections.append(f"### {path}\n\n" + "\n\n---\n\n".join(contents))
+        return "\n\n".join(sections)
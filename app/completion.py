@@ -2,102 +2,239 @@
 # -*- coding: utf-8 -*-
 #
 import os
+import time
+from functools import cached_property
 import backoff
 import openai
-import tiktoken
+import requests
+from metrics import RunMetrics
 from prompts import system_prompt
+from ratelimit import RateLimiter
+from streaming import IssueStreamParser
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
+# Function the model calls to report the issues it found
+functions = [
+    {
+        "name": "raise_issues",
+        "description": "Adds a review comment for a specific line of code in Github pull request",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "data": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "severity": {
+                                "type": "integer",
+                                "description": "The severity of the issue, measured as an integer points. 1 point for nits, 3 points for optimizations, and 5 points for errors."
+                            },
+                            "path": {
+                                "type": "string",
+                                "description": "The path of the file the comment applies to, as shown in its diff --git header."
+                            },
+                            "line": {
+                                "type": "integer",
+                                "description": "The line of the blob in the pull request diff that the comment applies to. Set line = -1 to comment on the whole file."
+                            },
+                            "body": {
+                                "type": "string",
+                                "description": "The text of the review comment containing feedback"
+                            }
+                        },
+                        "required": ["severity", "path", "line", "body"]
+                    }
+                }
+            },
+            "required": ["data"],
+        }
+    }
+]
+
+# Context window of the models by name prefix, the most specific first. Azure
+# deployments spell gpt-3.5 as gpt-35.
+MODEL_CONTEXT_TOKENS = [
+    ("gpt-4o", 128000),
+    ("gpt-4-turbo", 128000),
+    ("gpt-4-1106", 128000),
+    ("gpt-4-0125", 128000),
+    ("gpt-4-32k", 32768),
+    ("gpt-4", 8192),
+    ("gpt-3.5-turbo-16k", 16384),
+    ("gpt-35-turbo-16k", 16384),
+    ("gpt-3.5-turbo-1106", 16385),
+    ("gpt-3.5-turbo-0125", 16385),
+    ("gpt-3.5-turbo", 4096),
+    ("gpt-35-turbo", 4096),
+]
+# Unknown models are assumed to have the smallest context window
+DEFAULT_CONTEXT_TOKENS = 4096
+
+
+def context_tokens(model) -> int:
+    '''Context window of a model in tokens'''
+    for prefix, tokens in MODEL_CONTEXT_TOKENS:
+        if model.startswith(prefix):
+            return tokens
+    return DEFAULT_CONTEXT_TOKENS
+
+
+def record_backoff(details):
+    '''backoff handler counting the retries of an OpenAIClient call'''
+    details["args"][0].metrics.count("retries")
+
 
 class OpenAIClient:
     '''OpenAI API client'''
 
     def __init__(self, model, temperature, frequency_penalty, presence_penalty,
-                 max_tokens=8000, min_tokens=256):
+                 max_tokens=0, min_tokens=256, completion_tokens=1024, requests_per_minute=0, tokens_per_minute=0,
+                 metrics=None):
         self.model = model
         self.temperature = temperature
         self.frequency_penalty = frequency_penalty
         self.presence_penalty = presence_penalty
-        self.encoder = tiktoken.get_encoding("gpt2")
-        self.max_tokens = max_tokens
+        # the prompt and the completion share the context window of the model
+        self.max_tokens = max_tokens or context_tokens(model)
         self.min_tokens = min_tokens
+        self.completion_tokens = completion_tokens
         self.openai_kwargs = {'model': self.model}
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.metrics = metrics or RunMetrics()
+        # openai calls the factory for a session per thread, and recycles each on its own
+        openai.requestssession = self.make_session
+
+    @cached_property
+    def encoder(self):
+        '''Tokenizer of the model, loaded on first use'''
+        import tiktoken
+        try:
+            return tiktoken.encoding_for_model(self.model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+
+    def make_session(self) -> requests.Session:
+        '''requests session feeding the limiter with the rate limit headers of every completion response'''
+        session = requests.Session()
+        session.mount("https://", requests.adapters.HTTPAdapter(max_retries=2))
+        session.hooks["response"].append(self.on_response)
+        return session
+
+    def on_response(self, response, *args, **kwargs):
+        '''requests hook updating the rate limiter from chat completion responses'''
+        self.update_rate_limits(response.url, response.headers)
+
+    def update_rate_limits(self, url, headers):
+        '''Update the rate limiter from the headers of a chat completion response'''
+        if "/chat/completions" in url:
+            try:
+                self.rate_limiter.update(headers)
+            except ValueError as e:
+                print(f"Ignoring malformed rate limit headers with error {e}")
+
+    def encode(self, text) -> list:
+        with self.metrics.stage("tokenization"):
+            return self.encoder.encode(text)
 
     @backoff.on_exception(backoff.expo,
                           (openai.error.RateLimitError,
                            openai.error.APIConnectionError,
                            openai.error.ServiceUnavailableError),
-                          max_time=300)
+                          max_time=300,
+                          on_backoff=record_backoff)
     def get_image(self, prompt, size=1024, n=1):
-        return openai.Image.create(prompt=prompt, n=n, size=f"{size}x{size}")['data'][0]['url']
+        with self.metrics.stage("openai image"):
+            return openai.Image.create(prompt=prompt, n=n, size=f"{size}x{size}")['data'][0]['url']
+
+    def completion_request(self, prompt, sys_prompt=system_prompt, with_function=True, stream=False):
+        '''Arguments of a chat completion request, and its cost against the token quota'''
+        messages = [
+            {"role": "system", "content": sys_prompt},
+            {"role": "user", "content": prompt},
+        ]
+        prompt_tokens = len(self.encode(f'{sys_prompt}\n{prompt}'))
+        # a bounded completion, so a smaller prompt costs less of the token quota
+        max_tokens = max(1, min(self.completion_tokens, self.max_tokens - prompt_tokens))
+        kwargs = dict(
+            messages=messages,
+            temperature=self.temperature,
+            frequency_penalty=self.frequency_penalty,
+            presence_penalty=self.presence_penalty,
+            request_timeout=100,
+            max_tokens=max_tokens,
+            stream=stream, **self.openai_kwargs)
+        if with_function:
+            kwargs.update(functions=functions, function_call={"name": "raise_issues"})
+        # OpenAI counts the prompt plus the requested max_tokens against the quota
+        return kwargs, prompt_tokens + max_tokens
+
+    @backoff.on_exception(backoff.expo,
+                          (openai.error.RateLimitError,
+                           openai.error.APIConnectionError,
+                           openai.error.ServiceUnavailableError),
+                          max_time=300,
+                          on_backoff=record_backoff)
+    def create_completion(self, prompt, sys_prompt=system_prompt, with_function=True, stream=False):
+        '''Invoke OpenAI API to create a chat completion, retrying until it is accepted'''
+        kwargs, cost = self.completion_request(prompt, sys_prompt, with_function, stream)
+        self.rate_limiter.acquire(cost)
+        return openai.ChatCompletion.create(**kwargs)
 
     @backoff.on_exception(backoff.expo,
                           (openai.error.RateLimitError,
                            openai.error.APIConnectionError,
                            openai.error.ServiceUnavailableError),
-                          max_time=300)
+                          max_time=300,
+                          on_backoff=record_backoff)
+    async def acreate_completion(self, prompt, sys_prompt=system_prompt, with_function=True):
+        '''Async create_completion, over the aiohttp session set in openai.aiosession'''
+        kwargs, cost = self.completion_request(prompt, sys_prompt, with_function)
+        await self.rate_limiter.aacquire(cost)
+        return await openai.ChatCompletion.acreate(**kwargs)
+
+    def record_usage(self, response, start):
+        usage = response.get("usage", {})
+        self.metrics.add_completion(self.model, time.perf_counter() - start,
+                                    usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+
     def get_completion(self, prompt, sys_prompt=system_prompt, with_function=True) -> str:
         '''Invoke OpenAI API to get chat completion'''
-        messages = [
-            {"role": "system", "content": sys_prompt},
-            {"role": "user", "content": prompt},
-        ]
-        functions = [
-            {
-                "name": "raise_issues",
-                "description": "Adds a review comment for a specific line of code in Github pull request",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "data": {
-                            "type": "array",
-                            "items": {
-                                "type": "object",
-                                "properties": {
-                                    "severity": {
-                                        "type": "integer",
-                                        "description": "The severity of the issue, measured as an integer points. 1 point for nits, 3 points for optimizations, and 5 points for errors."
-                                    },
-                                    "line": {
-                                        "type": "integer",
-                                        "description": "The line of the blob in the pull request diff that the comment applies to. Set line = -1 to comment on the whole file."
-                                    },
-                                    "body": {
-                                        "type": "string",
-                                        "description": "The text of the review comment containing feedback"
-                                    }
-                                },
-                                "required": ["severity", "line", "body"]
-                            }
-                        }
-                    },
-                    "required": ["data"],
-                }
-            }
-        ]
-        if with_function:
-            response = openai.ChatCompletion.create(
-                messages=messages,
-                functions=functions,
-                function_call={"name": "raise_issues"},
-                temperature=self.temperature,
-                frequency_penalty=self.frequency_penalty,
-                presence_penalty=self.presence_penalty,
-                request_timeout=100,
-                max_tokens=self.max_tokens - len(self.encoder.encode(f'{system_prompt}\n{prompt}')),
-                stream=False, **self.openai_kwargs)
-        else:
-            response = openai.ChatCompletion.create(
-                messages=messages,
-                temperature=self.temperature,
-                frequency_penalty=self.frequency_penalty,
-                presence_penalty=self.presence_penalty,
-                request_timeout=100,
-                max_tokens=self.max_tokens - len(self.encoder.encode(f'{system_prompt}\n{prompt}')),
-                stream=False, **self.openai_kwargs)
+        start = time.perf_counter()
+        response = self.create_completion(prompt, sys_prompt, with_function)
+        self.record_usage(response, start)
+        return response.choices[0].message
+
+    async def aget_completion(self, prompt, sys_prompt=system_prompt, with_function=True) -> str:
+        '''Invoke OpenAI API to get chat completion without blocking the event loop'''
+        start = time.perf_counter()
+        response = await self.acreate_completion(prompt, sys_prompt, with_function)
+        self.record_usage(response, start)
         return response.choices[0].message
 
+    def get_issues_stream(self, prompt, sys_prompt=system_prompt):
+        '''Stream a raise_issues completion, yielding each issue as soon as it is complete.
+
+        Only opening the stream is retried. An error while streaming is raised
+        after the issues received so far have been yielded.
+        '''
+        parser = IssueStreamParser()
+        start = time.perf_counter()
+        # streamed responses carry no usage, each chunk is about one token
+        chunks = 0
+        try:
+            for chunk in self.create_completion(prompt, sys_prompt, with_function=True, stream=True):
+                chunks += 1
+                if not chunk.choices:
+                    continue
+                function_call = chunk.choices[0].delta.get("function_call")
+                if function_call is not None and function_call.get("arguments"):
+                    yield from parser.feed(function_call["arguments"])
+        finally:
+            self.metrics.add_completion(self.model, time.perf_counter() - start,
+                                        len(self.encode(f'{sys_prompt}\n{prompt}')), chunks)
+
     def get_pr_prompt(self, title, body, changes) -> str:
         '''Generate a prompt for a PR review'''
         return f"""
@@ -126,16 +263,41 @@ class OpenAIClient:
         ```
         """
 
+    def get_files_prompt(self, title, body, changes) -> str:
+        '''Generate a prompt for reviewing several small files at once'''
+        return f"""        
+        ### Pull Request Title: {title}
+
+        ### Pull Request Description: 
+        {body}
+
+        ### Changes for several files, each starting with its diff --git header. Set the path of every comment to the file it applies to. Removed lines begin with minus (-). Added lines begin with plus (+):
+        ```
+        {changes}
+        ```
+        """
+
     def get_file_prompt_contents(self, title, body, filename, contents) -> str:
         return f"""        
         ### Please respond with your feedback for this file. Each point of feedback should include severity, line, and comment.
 
-        ### Contents for file {filename}:
+        ### Contents for file {filename}, each line prefixed with its line number:
         ```
         {contents}
         ```
         """
 
+    def get_file_prompt_excerpts(self, title, body, filename, excerpts) -> str:
+        '''Generate a prompt for the changed parts of a file, with their enclosing functions and classes'''
+        return f"""        
+        ### Please respond with your feedback for the changes in this file. Each point of feedback should include severity, line, and comment.
+
+        ### Changed parts of file {filename}, each line prefixed with its line number:
+        ```
+        {excerpts}
+        ```
+        """
+
 
 if __name__ == "__main__":
     import githubs
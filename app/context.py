@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+import ast
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from chunking import HUNK_HEADER
+
+
+# Lines closing a block in brace and keyword delimited languages
+BLOCK_CLOSERS = ("}", ")", "]", "end", "fi", "done", "esac")
+
+
+def changed_lines(patch) -> list:
+    '''Sorted lines of the new file touched by a patch, a deletion touches the line after it'''
+    lines = set()
+    new_line = None
+    for line in (patch or "").splitlines():
+        match = HUNK_HEADER.match(line)
+        if match:
+            new_line = int(match.group(2))
+            continue
+        if new_line is None or line.startswith("\\"):
+            continue
+        if line.startswith("+"):
+            lines.add(new_line)
+            new_line += 1
+        elif line.startswith("-"):
+            lines.add(max(new_line, 1))
+        else:
+            new_line += 1
+    return sorted(lines)
+
+
+def merge_ranges(ranges) -> list:
+    '''Merge overlapping and adjacent (start, end) line ranges'''
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def python_scopes(text):
+    '''(start, end) lines of every function and class, decorators included, None if text does not parse'''
+    try:
+        tree = ast.parse(text)
+    except (SyntaxError, ValueError):
+        return None
+    scopes = []
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            start = min([node.lineno] + [decorator.lineno for decorator in node.decorator_list])
+            scopes.append((start, node.end_lineno))
+    return scopes
+
+
+def indent(line) -> int:
+    return len(line) - len(line.lstrip())
+
+
+def indent_scopes(lines, line) -> list:
+    '''Blocks enclosing line (1-based) by indentation, innermost first.
+
+    A block starts at a less indented line and ends before the next line
+    indented no deeper than its start, or on it when that line closes the
+    block, as a brace does.
+    '''
+    at = line - 1
+    while at < len(lines) and not lines[at].strip():
+        at += 1
+    if at >= len(lines):
+        return []
+    scopes = []
+    level = indent(lines[at])
+    for i in range(at - 1, -1, -1):
+        if not lines[i].strip() or indent(lines[i]) >= level:
+            continue
+        level = indent(lines[i])
+        start = i
+        # the opening brace of Allman style code is on a line of its own
+        if lines[i].strip().startswith("{") and i > 0:
+            start = i - 1
+        end = len(lines) - 1
+        for j in range(at + 1, len(lines)):
+            if lines[j].strip() and indent(lines[j]) <= level:
+                end = j if lines[j].strip().startswith(BLOCK_CLOSERS) else j - 1
+                break
+        while end > at and not lines[end].strip():
+            end -= 1
+        scopes.append((start + 1, end + 1))
+        if level == 0:
+            break
+    return scopes
+
+
+class ContextSelector:
+    '''Select the parts of a file a review of its changes needs.
+
+    Every change gets a few lines of context, then the selection grows to the
+    enclosing functions and classes, innermost first, as long as it fits in
+    the token budget. Python is scoped by its AST, other languages by
+    indentation.
+    '''
+
+    def __init__(self, token_budget, context_lines=3):
+        self.token_budget = token_budget
+        self.context_lines = context_lines
+
+    def scope_chains(self, filename, lines, spans) -> list:
+        '''Scopes enclosing each (first, last) span of changed lines, innermost first'''
+        scopes = python_scopes('\n'.join(lines)) if filename.endswith((".py", ".pyi")) else None
+        chains = []
+        for start, end in spans:
+            if scopes is not None:
+                chain = sorted((scope for scope in scopes if scope[0] <= start and scope[1] >= end),
+                               key=lambda scope: scope[1] - scope[0])
+            else:
+                chain = [scope for scope in indent_scopes(lines, start) if scope[1] >= end]
+            chains.append(chain)
+        return chains
+
+    def select(self, filename, lines, counts, patch, max_tokens) -> list:
+        '''Merged (start, end) line ranges, 1-based and inclusive, to review the changes of patch.
+
+        counts are the token counts of lines. The changes are always selected,
+        even when they alone are over max_tokens.
+        '''
+        changed = [line for line in changed_lines(patch) if line <= len(lines)]
+        if not changed:
+            return []
+        ranges = merge_ranges((max(1, line - self.context_lines), min(len(lines), line + self.context_lines))
+                              for line in changed)
+        spans = [(changed[bisect_left(changed, start)], changed[bisect_right(changed, end) - 1])
+                 for start, end in ranges]
+        chains = self.scope_chains(filename, lines, spans)
+        totals = [0] + list(accumulate(counts))
+
+        def tokens(selection):
+            return sum(totals[end] - totals[start - 1] for start, end in merge_ranges(selection))
+
+        # widen all the changes one scope level at a time, so none is left without its function
+        selection = list(ranges)
+        for level in range(max((len(chain) for chain in chains), default=0)):
+            for i, chain in enumerate(chains):
+                if level >= len(chain):
+                    continue
+                scope = (min(chain[level][0], selection[i][0]), max(chain[level][1], selection[i][1]))
+                widened = selection[:i] + [scope] + selection[i + 1:]
+                if tokens(widened) <= max_tokens:
+                    selection = widened
+        return merge_ranges(selection)
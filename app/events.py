@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Event handling that must stay cheap to import: main.py decides whether
+# there is any work before loading the OpenAI, Github and tiktoken clients.
+
+
+# List of event types
+EVENT_TYPE_PUSH = "push"
+EVENT_TYPE_COMMENT = "comment"
+EVENT_TYPE_PULL_REQUEST = "pull_request"
+EVENT_TYPE_OTHER = "other"
+
+
+def get_event_type(payload) -> str:
+    '''Determine the type of event'''
+    if payload.get("head_commit") is not None:
+        return EVENT_TYPE_PUSH
+
+    if payload.get("pull_request") is not None:
+        return EVENT_TYPE_PULL_REQUEST
+
+    if payload.get("comment") is not None:
+        return EVENT_TYPE_COMMENT
+
+    return EVENT_TYPE_OTHER
@@ -1,135 +1,320 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 #
+import asyncio
 import json
 import os
-import requests
 import random
-from github import Github
-
-
-# List of event types
-EVENT_TYPE_PUSH = "push"
-EVENT_TYPE_COMMENT = "comment"
-EVENT_TYPE_PULL_REQUEST = "pull_request"
-EVENT_TYPE_OTHER = "other"
+from collections import Counter
+from itertools import chain
+from functools import cached_property
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import openai
+import requests
+from github import Github, GithubException
+from budget import TokenBudget
+from chunking import Chunker
+from cache import CompletionCache, content_hash
+from comments import ReviewComments
+from context import ContextSelector
+from events import (EVENT_TYPE_COMMENT, EVENT_TYPE_OTHER,  # noqa: F401
+                    EVENT_TYPE_PULL_REQUEST, EVENT_TYPE_PUSH, get_event_type)
+from memes import DEFAULT_MAX_AGE, DEFAULT_POOL_SIZE, MemePool, run_in_background
+from prompts import system_prompt
+from pullrequest import PullRequestContext
+from transport import AsyncGithubAPI, AsyncTransport
+from triage import FileTriage, decode_text, format_failed, format_skipped
 
 
 class GithubClient:
     '''Github API client'''
 
-    def __init__(self, openai_client, review_per_file=False, comment_per_file=False, blocking=False):
+    def __init__(self, openai_client, review_per_file=False, comment_per_file=False, blocking=False,
+                 max_workers=1, completion_cache=None, incremental=False, report_path="",
+                 file_triage=None, async_transport=False, context_tokens=0, meme=True, meme_timeout=10,
+                 meme_max_age=DEFAULT_MAX_AGE, meme_pool_size=DEFAULT_POOL_SIZE, review_mode="files"):
         self.openai_client = openai_client
         self.github_token = os.getenv("GITHUB_TOKEN")
-        self.github_client = Github(self.github_token)
+        # GITHUB_API_URL is set by Actions, and points at the API of GitHub Enterprise Server too
+        self.github_client = Github(self.github_token, per_page=100,
+                                    base_url=os.getenv("GITHUB_API_URL") or "https://api.github.com")
+        # keep-alive session for the raw GitHub requests made outside PyGithub
+        self.http = requests.Session()
         self.review_tokens = self.openai_client.max_tokens - self.openai_client.min_tokens
         self.review_per_file = review_per_file
         self.comment_per_file = comment_per_file
         self.blocking = blocking
+        self.max_workers = max_workers
+        self.completion_cache = completion_cache or CompletionCache()
+        self.incremental = incremental
+        self.report_path = report_path
+        self.metrics = self.openai_client.metrics
+        self.file_triage = file_triage or FileTriage()
+        self.async_transport = async_transport
+        self.context_tokens = context_tokens
+        self.meme = meme
+        self.meme_timeout = meme_timeout
+        self.meme_pool = MemePool(self.completion_cache.backend, meme_max_age, meme_pool_size)
+        self.review_mode = review_mode
+
+    @cached_property
+    def token_budget(self):
+        # the raw tokenizer, as per line timings would cost as much as the tokenization
+        return TokenBudget(self.openai_client.encoder, self.review_tokens, self.metrics)
+
+    @cached_property
+    def chunker(self):
+        return Chunker(self.token_budget)
+
+    @cached_property
+    def context_selector(self):
+        return ContextSelector(self.token_budget)
 
     def get_event_type(self, payload) -> str:
         '''Determine the type of event'''
-        if payload.get("head_commit") is not None:
-            return EVENT_TYPE_PUSH
-
-        if payload.get("pull_request") is not None:
-            return EVENT_TYPE_PULL_REQUEST
-
-        if payload.get("comment") is not None:
-            return EVENT_TYPE_COMMENT
-
-        return EVENT_TYPE_OTHER
-
-    def get_pull_request(self, payload):
-        '''Get the pull request'''
-        repo = self.github_client.get_repo(os.getenv("GITHUB_REPOSITORY"))
-        pr = repo.get_pull(payload.get("number"))
-        changes = requests.get(pr.url,
-                               timeout=30,
-                               headers={"Authorization": "Bearer " + self.github_token,
-                                        "Accept": "application/vnd.github.v3.diff"},
-                               ).text
-        return pr, changes
-
-    def cut_changes(self, previous_filename, filename, patch):
-        '''Cut the changes to fit the max tokens'''
-        if previous_filename is None:
-            previous_filename = filename
-
-        # add a patch header
-        patch = f'diff --git a/{previous_filename} b/{filename}\n{patch}'
-        if len(self.openai_client.encoder.encode(patch)) < self.review_tokens:
-            return patch
-
-        # TODO: it is not a good idea to cut the contents, need figure out a better way
-        lines = patch.splitlines()
-        print(
-            f"The changes for {filename} is too long, contents would be cut to fit the max tokens")
-        i = len(lines)
-        while i > 0:
-            i -= 1
-            line = '\n'.join(lines[:i])
-            if len(self.openai_client.encoder.encode(line)) < self.review_tokens:
-                return line
-        return ''
-
-    def get_issues(self, prompt) -> list:
-        '''Gets a list of issues: { severity: int, line: int, body: str } '''
+        return get_event_type(payload)
+
+    def get_pull_request(self, payload, repo_name=None) -> PullRequestContext:
+        '''Get the pull request context, resolved lazily as the review needs it.
+
+        repo_name defaults to the repository of the workflow run.
+        '''
+        repo_name = repo_name or os.getenv("GITHUB_REPOSITORY") or payload.get("repository", {}).get("full_name")
+        return PullRequestContext(self.github_client, self.github_token, repo_name, payload, self.metrics,
+                                  http=self.http)
+
+    def prompt_budget(self, template) -> int:
+        '''Tokens left for the reviewed content once the prompt template is in'''
+        return self.review_tokens - len(self.openai_client.encode(f'{system_prompt}\n{template}'))
+
+    def chunk_changes(self, ctx, file) -> list:
+        '''Split a file's patch into chunks that each fit in one prompt'''
+        if not file.patch:
+            return []
+        with self.metrics.stage("prompt build"):
+            previous_filename = file.previous_filename or file.filename
+            template = self.openai_client.get_file_prompt(ctx.pr.title, ctx.pr.body, file.filename, '')
+            patch = f'diff --git a/{previous_filename} b/{file.filename}\n{file.patch}'
+            return self.chunker.split_patch(patch, self.prompt_budget(template))
+
+    def merge_chunk_comments(self, chunks, results):
+        '''Merge the comments on each chunk of a file, labelled with the lines they cover'''
+        if len(chunks) == 1:
+            return results[0]
+        sections = [f"#### Lines {chunk.start_line}-{chunk.end_line}\n\n{comments}"
+                    for chunk, comments in zip(chunks, results) if comments is not None]
+        return "\n\n".join(sections) if sections else None
+
+    def cache_key(self, content_sha, template) -> str:
+        '''Completion cache key for content reviewed with the given prompt template'''
+        return self.completion_cache.key(content_sha, f'{system_prompt}\n{template}',
+                                         self.openai_client.model, self.openai_client.temperature)
+
+    def get_issues(self, prompt):
+        '''Gets a list of issues: { severity: int, line: int, body: str }, and whether it is complete'''
         try:
             completion = self.openai_client.get_completion(prompt)
             if completion is not None and "function_call" in completion:
-                return json.loads(completion["function_call"]["arguments"]).get("data", [])
-            return []
+                return json.loads(completion["function_call"]["arguments"]).get("data", []), True
+            return [], False
         except Exception as e:
-            print(f"OpenAI failed on prompt {prompt} with exception {e}")
-            return []
+            print(f"OpenAI failed on a {len(prompt)} characters prompt with exception {e}")
+            return [], False
+
+    def completion_comments(self, completion, cache_key=None):
+        if completion is not None and "content" in completion:
+            if cache_key is not None:
+                self.completion_cache.set(cache_key, completion["content"])
+            return completion["content"]
+        return None
 
-    def get_file_comments(self, prompt):
+    def get_file_comments(self, prompt, cache_key=None):
         try:
             completion = self.openai_client.get_completion(prompt, with_function=False)
-            if completion is not None and "content" in completion:
-                return completion["content"]
+            return self.completion_comments(completion, cache_key)
+        except Exception as e:
+            print(f"OpenAI failed on a {len(prompt)} characters prompt with exception {e}")
             return None
+
+    async def aget_file_comments(self, prompt, cache_key=None):
+        try:
+            completion = await self.openai_client.aget_completion(prompt, with_function=False)
+            return self.completion_comments(completion, cache_key)
         except Exception as e:
-            print(f"OpenAI failed on prompt {prompt} with exception {e}")
+            print(f"OpenAI failed on a {len(prompt)} characters prompt with exception {e}")
             return None
 
+    def map_files(self, func, files):
+        '''Run func for each file on the worker pool, yielding (file, result) in input order'''
+        if self.max_workers <= 1:
+            for file in files:
+                yield file, func(file)
+            return
 
-    def review_by_issues(self, pr):
-        # Review each file changes separately
-        files_changed = pr.get_files()
-        total_severity = 0
-        review_comments = []
-        for file in files_changed:
-            file_changes = self.cut_changes(
-                file.previous_filename, file.filename, file.patch)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            yield from zip(files, executor.map(func, files))
+
+    def pack_chunks(self, ctx, chunks) -> list:
+        '''Group the chunks into prompts, packing small files together up to the token budget.
+
+        Files split into several chunks, or using more than a quarter of the
+        budget, keep a prompt of their own. The others fill the first prompt
+        they fit in, in file order.
+        '''
+        with self.metrics.stage("prompt build"):
+            template = self.openai_client.get_files_prompt(ctx.pr.title, ctx.pr.body, '')
+            budget = self.prompt_budget(template)
+        file_chunks = Counter(file.filename for file, _ in chunks)
+        prompts, packed = [], []
+        for file, chunk in chunks:
+            if file_chunks[file.filename] > 1 or chunk.tokens > budget // 4:
+                prompts.append([(file, chunk)])
+                continue
+            # a couple of tokens for the separator between patches
+            tokens = chunk.tokens + 2
+            for group in packed:
+                if group[0] + tokens <= budget:
+                    group[0] += tokens
+                    group[1].append((file, chunk))
+                    break
+            else:
+                packed.append([tokens, [(file, chunk)]])
+                prompts.append(packed[-1][1])
+        return prompts
+
+    def split_issues(self, group, issues):
+        '''Split the issues of a packed prompt back per file: ([(filename, issues)], issues on unknown paths)'''
+        if len(group) == 1:
+            return [(group[0][0].filename, issues)], []
+        by_path = {file.filename: [] for file, _ in group}
+        unknown = []
+        for issue in issues:
+            path = issue.get("path", "")
+            if path not in by_path and path[:2] in ("a/", "b/"):
+                path = path[2:]
+            if path in by_path:
+                by_path[path].append(issue)
+            else:
+                unknown.append(issue)
+        return list(by_path.items()), unknown
+
+    def chunk_cache_key(self, ctx, file, chunk) -> str:
+        '''Completion cache key of the issues on one chunk of a file's changes, packed or not'''
+        template = self.openai_client.get_file_prompt(ctx.pr.title, ctx.pr.body, file.filename, '')
+        return self.cache_key(content_hash(chunk.text), template)
+
+    def review_file_changes(self, ctx, group):
+        '''Get the issues for a group of chunks reviewed in one prompt'''
+        # chunks keep the real hunk headers, so issue lines already refer to the file
+        if len(group) == 1:
+            file, chunk = group[0]
             prompt = self.openai_client.get_file_prompt(
-                pr.title, pr.body, file.filename, file_changes)
-            issues = self.get_issues(prompt)
-            for issue in issues:
-                print(prompt)
-                print(issue)
-                severity = issue.get("severity", 0)
-                line = issue.get("line", -1)
-                body = issue.get("body", "")
-
-                # Create a review comment on the file
-                self.submit_pr_comment(pr, file.filename, severity, line, body)
-                review_comments.append({
-                    "path": file.filename,
-                    "body": body,
-                    "line": line,
-                })
-                total_severity += severity
+                ctx.pr.title, ctx.pr.body, file.filename, chunk.text)
+        else:
+            changes = '\n\n'.join(chunk.text for _, chunk in group)
+            prompt = self.openai_client.get_files_prompt(ctx.pr.title, ctx.pr.body, changes)
+        with self.metrics.file(", ".join(file.filename for file, _ in group)):
+            issues, complete = self.get_issues(prompt)
+        file_issues, unknown = self.split_issues(group, issues)
+        if unknown:
+            # the issues cannot be told apart, so each file is reviewed on its own instead
+            print(f"{len(unknown)} issues on unknown paths, reviewing {len(group)} packed files one by one")
+            reviews = [self.review_file_changes(ctx, [item]) for item in group]
+            return prompt, [item for _, items, _ in reviews for item in items], all(c for _, _, c in reviews)
+        if complete:
+            # cached per chunk, so a change to one file leaves the files packed with it cached
+            by_path = dict(file_issues)
+            for file, chunk in group:
+                self.completion_cache.set(self.chunk_cache_key(ctx, file, chunk), by_path.get(file.filename, []))
+        return prompt, file_issues, complete
+
+    def triage_files(self, files, skip):
+        '''Split files into those to review and the (path, reason) of those skipped'''
+        kept, skipped = [], []
+        for file in files:
+            reason = "removed" if file.status == "removed" else skip(file)
+            if reason is None:
+                kept.append(file)
+            else:
+                print(f"Skipping {file.filename}: {reason}")
+                skipped.append((file.filename, reason))
+        return kept, skipped
 
+    def review_by_issues(self, ctx):
+        # Review each file changes separately
+        review_comments = ReviewComments()
+        ctx.resolve()
+        files, skipped = self.triage_files(self.get_files_to_review(ctx, ctx.files),
+                                           self.file_triage.skip_patch)
+        if not files:
+            if skipped:
+                ctx.create_review(body=f"Total Comments: 0\n\n{format_skipped(skipped)}", event="COMMENT")
+            return
+        chunks = [(file, chunk) for file in files for chunk in self.chunk_changes(ctx, file)]
+        # chunks are looked up before packing, so only the uncached ones are sent
+        cached, misses = [], []
+        for file, chunk in chunks:
+            issues = self.completion_cache.get(self.chunk_cache_key(ctx, file, chunk))
+            if issues is None:
+                misses.append((file, chunk))
+            else:
+                cached.append((file.filename, issues))
+        reviews = self.map_files(lambda group: self.review_file_changes(ctx, group),
+                                 self.pack_chunks(ctx, misses))
+        # findings are anchored to the pull request diff, even when reviewing a delta
+        pr_patches = {file.filename: file.patch for file in ctx.files}
+        failed = set()
+        for file_issues, complete in chain([(cached, True)], (
+                (file_issues, complete) for _, (_, file_issues, complete) in reviews)):
+            for filename, issues in file_issues:
+                if not complete:
+                    failed.add(filename)
+                review_comments.add_file(filename, pr_patches.get(filename))
+                print(f"{filename}: {len(issues)} issues")
+                for issue in issues:
+                    review_comments.add(filename,
+                                        issue.get("severity", 0),
+                                        issue.get("line", -1),
+                                        issue.get("body", ""))
+
+        # Post every finding of the run in a single review
+        total_severity = review_comments.total_severity
         review_status = "APPROVED" if total_severity < 5 else "REQUEST_CHANGES"
         review_body = f"Status: {review_status}\nTotal Severity: {total_severity}\nTotal Comments: {len(review_comments)}"
-        pr.create_review(list(pr.get_commits())[-1], body=review_body,
-                         event=review_status)  # , comments=review_comments)
+        if failed:
+            review_body += f"\n\n{format_failed(sorted(failed))}"
+        if skipped:
+            review_body += f"\n\n{format_skipped(skipped)}"
+        # the head commit is only marked as reviewed when every file was, so the next incremental run retries them
+        self.post_issues_review(ctx, review_comments, review_body,
+                                "APPROVE" if review_status == "APPROVED" else review_status, marker=not failed)
+
+    def post_issues_review(self, ctx, review_comments, summary, event, marker=True):
+        '''Post the findings as one review, falling back to a COMMENT review, then to one without inline comments.
+
+        GITHUB_TOKEN may not approve pull requests, and a single stale position
+        fails the whole review, so every finding would be lost otherwise.
+        '''
+        comments = review_comments.comments
+        attempts = [(event, comments, review_comments.review_body(summary))]
+        if event != "COMMENT":
+            attempts.append(("COMMENT", comments, review_comments.review_body(summary)))
+        if comments:
+            attempts.append(("COMMENT", [], review_comments.review_body(summary, inline=True)))
+        for i, (event, comments, body) in enumerate(attempts):
+            try:
+                return ctx.create_review(body=body, event=event, comments=comments, marker=marker)
+            except GithubException as e:
+                if i == len(attempts) - 1:
+                    raise
+                print(f"Failed to post a {event} review with {len(comments)} inline comments with error: {e}")
 
     def generate_meme_image_url(self):
         seed = "❤️🎃✅🔥💀🫶✨😊😂⭐👻👍✔️🎉👉👀👇🌔😭🚀🥹➡️👋😉🙏🫡😍🤔💪🤓"
         seed = seed[random.randint(0, len(seed) - 1)]
+        pooled = self.meme_pool.get(seed)
+        if pooled is not None:
+            return pooled
         system_prompt = "You are a creative meme generator. Your task is to take a random emoji as a seed and generate a prompt that an image generation model will use to create a meme. The meme should be funny and relatable to engineers and employees of the crypto startup Uniswap Labs. Use the emoji to inspire the theme or subject of the meme. Let's make some memes!"
         try:
             prompt = f"Respond with 10 descriptive words based on this emoji that could be used to generate a funny meme: {seed}. Respond with the 10 words and nothing else, don't enumerate them either."
@@ -139,53 +324,309 @@ class GithubClient:
             if meme_prompt is None or "content" not in meme_prompt:
                 return None
             meme_prompt = meme_prompt["content"]
-            return meme_prompt, self.openai_client.get_image(f"cartoon internet meme celebration {meme_prompt}")
+            image_url = self.openai_client.get_image(f"cartoon internet meme celebration {meme_prompt}")
+            self.meme_pool.add(seed, meme_prompt, image_url)
+            return meme_prompt, image_url
         except Exception as e:
             print(f"OpenAI failed on meme prompt generation with exception {e}")
             return None
 
-    def add_review_meme(self, pr):
-        res = self.generate_meme_image_url()
-        if res is None:
+    def meme_review_body(self, summary, res):
+        body = summary
+        if res is not None:
+            print(res)
+            prompt, image_url = res
+            body += f"\n\nGreat work! Here's a congratulatory AI generated meme!\n\n ![meme]({image_url})"
+        return body
+
+    def start_meme(self):
+        '''Start generating the meme alongside the reviews, None when memes are disabled'''
+        if not self.meme:
+            return None
+        return run_in_background(self.generate_meme_image_url)
+
+    def wait_meme(self, meme):
+        '''The started meme, if it is ready within meme_timeout seconds'''
+        if meme is None:
+            return None
+        try:
+            return meme.result(timeout=self.meme_timeout)
+        except TimeoutError:
+            print(f"The meme is not ready after {self.meme_timeout}s, posting the summary without it")
+            return None
+        except Exception as e:
+            print(f"Meme generation failed with error: {e}")
+            return None
+
+    def add_review_meme(self, ctx, summary, meme=None, marker=True):
+        '''Close the run with a summary review, which also marks the head commit as reviewed if marker is set'''
+        ctx.create_review(body=self.meme_review_body(summary, self.wait_meme(meme)), event="COMMENT", marker=marker)
+
+    async def aadd_review_meme(self, ctx, summary, meme=None, marker=True):
+        res = await asyncio.to_thread(self.wait_meme, meme)
+        await ctx.acreate_review(body=self.meme_review_body(summary, res), event="COMMENT", marker=marker)
+
+    def get_files_to_review(self, ctx, files):
+        '''In incremental mode, narrow files down to the delta since the last reviewed commit'''
+        if not self.incremental:
+            return files
+
+        base_sha = ctx.last_reviewed_sha
+        if base_sha is None:
+            print("No previous review found, reviewing all files")
+            return files
+        if base_sha == ctx.head_sha:
+            print(f"{base_sha} has already been reviewed")
+            return []
+
+        changed = ctx.compare_files(base_sha)
+        if changed is None:
+            print(f"{base_sha} is not an ancestor of {ctx.head_sha} (force-push?), reviewing all files")
+            return files
+        print(f"Reviewing {len(changed)} files changed since {base_sha}")
+        return changed
+
+    def use_excerpts(self, file) -> bool:
+        '''Whether to review only the changed parts of a file, rather than all of it'''
+        return self.context_tokens > 0 and bool(file.patch) and file.status != "added"
+
+    def file_prompt(self, ctx, file, chunk=None) -> str:
+        '''Prompt reviewing a chunk of a file, the prompt template without a chunk'''
+        if self.use_excerpts(file):
+            return self.openai_client.get_file_prompt_excerpts(ctx.pr.title, ctx.pr.body, file.filename,
+                                                               chunk.text if chunk else '')
+        return self.openai_client.get_file_prompt_contents(ctx.pr.title, ctx.pr.body, file.filename,
+                                                           chunk.text if chunk else '')
+
+    def lookup_file_comments(self, ctx, file):
+        '''Prompt template, cache key and cached comments of a file reviewed by its contents'''
+        template = self.file_prompt(ctx, file)
+        # the blob SHA addresses the contents, so a hit skips fetching them too
+        content_sha = content_hash(file.sha, file.patch) if self.use_excerpts(file) else file.sha
+        cache_key = self.cache_key(content_sha, template)
+        return template, cache_key, self.completion_cache.get(cache_key)
+
+    def chunk_file_contents(self, file, template, contents):
+        '''Split a file's contents into chunks for review: (chunks, reason to skip the file)'''
+        file_contents = decode_text(contents)
+        reason = self.file_triage.skip_contents(contents, file_contents)
+        if reason is not None:
+            return [], reason
+        with self.metrics.stage("prompt build"):
+            budget = self.prompt_budget(template)
+            if not self.use_excerpts(file):
+                return self.chunker.split_contents(file_contents, budget), None
+            lines = file_contents.splitlines()
+            counts = self.token_budget.count_lines(lines)
+            ranges = self.context_selector.select(file.filename, lines, counts, file.patch,
+                                                  min(self.context_tokens, budget))
+            if not ranges:
+                # the patch does not match the contents, review the whole file
+                ranges = [(1, len(lines))] if lines else []
+            chunks = self.chunker.split_excerpts(lines, ranges, budget)
+        self.metrics.count("file_tokens", sum(counts))
+        self.metrics.count("excerpt_tokens", sum(chunk.tokens for chunk in chunks))
+        return chunks, None
+
+    def fetch_file_chunks(self, ctx, file):
+        '''Get a file's comments from the cache, or fetch and chunk its contents for review.
+
+        Returns (cache key, cached comments, chunks, reason to skip the file), None on failure.
+        '''
+        try:
+            template, cache_key, comments = self.lookup_file_comments(ctx, file)
+            if comments is not None:
+                return cache_key, comments, [], None
+            chunks, reason = self.chunk_file_contents(file, template, ctx.get_contents(file.filename))
+            if reason is not None:
+                return None, None, [], reason
+            return cache_key, None, chunks, None
+        except Exception as e:
+            print(f"Failed {file.filename} with error: {e}")
+            return None
+
+    async def afetch_file_chunks(self, ctx, file):
+        '''fetch_file_chunks over the async transport'''
+        try:
+            template, cache_key, comments = self.lookup_file_comments(ctx, file)
+            if comments is not None:
+                return cache_key, comments, [], None
+            chunks, reason = self.chunk_file_contents(file, template, await ctx.aget_contents(file.filename))
+            if reason is not None:
+                return None, None, [], reason
+            return cache_key, None, chunks, None
+        except Exception as e:
+            print(f"Failed {file.filename} with error: {e}")
+            return None
+
+    def review_file_contents(self, ctx, file, chunk):
+        '''Get free-form comments for one chunk of a file at the head commit'''
+        prompt = self.file_prompt(ctx, file, chunk)
+        with self.metrics.file(file.filename):
+            return prompt, self.get_file_comments(prompt)
+
+    async def areview_file_contents(self, ctx, file, chunk):
+        prompt = self.file_prompt(ctx, file, chunk)
+        with self.metrics.file(file.filename):
+            return prompt, await self.aget_file_comments(prompt)
+
+    def review_files(self, ctx, files):
+        '''Fetch and review files on the worker pools, yielding (file, fetched, chunk comments) in input order.
+
+        The chunks of a file are submitted for review as soon as its contents
+        are fetched, to a pool of their own so they never wait behind the
+        fetches of the later files.
+        '''
+        if self.max_workers <= 1:
+            for file in files:
+                fetched = self.fetch_file_chunks(ctx, file)
+                chunks = fetched[2] if fetched else []
+                yield file, fetched, [self.review_file_contents(ctx, file, chunk)[1] for chunk in chunks]
+            return
+
+        # the fetchers shut down first, as they submit to the reviewers
+        with ThreadPoolExecutor(max_workers=self.max_workers) as reviewers, \
+                ThreadPoolExecutor(max_workers=self.max_workers) as fetchers:
+            def fetch(file):
+                fetched = self.fetch_file_chunks(ctx, file)
+                chunks = fetched[2] if fetched else []
+                return fetched, [reviewers.submit(self.review_file_contents, ctx, file, chunk) for chunk in chunks]
+
+            for file, future in [(file, fetchers.submit(fetch, file)) for file in files]:
+                fetched, reviews = future.result()
+                yield file, fetched, [review.result()[1] for review in reviews]
+
+    def merge_file_review(self, file, fetched, results, skipped, failed):
+        '''Comments to post on a file once all its chunks are reviewed, None for no comment'''
+        if fetched is None:
+            failed.append(file.filename)
+            return None
+        cache_key, comments, file_chunks, reason = fetched
+        if reason is not None:
+            print(f"Skipping {file.filename}: {reason}")
+            skipped.append((file.filename, reason))
+            return None
+        if file_chunks:
+            comments = self.merge_chunk_comments(file_chunks, results)
+            # only cache complete reviews
+            if all(c is not None for c in results):
+                self.completion_cache.set(cache_key, comments)
+            else:
+                failed.append(file.filename)
+        print(f"{file.filename}: {'commented' if comments is not None else 'no comments'}")
+        return comments
+
+    def files_summary(self, reviewed, skipped, failed=()) -> str:
+        sections = [f"Reviewed {reviewed} files", format_failed(failed), format_skipped(skipped)]
+        return "\n\n".join(section for section in sections if section)
+
+    def post_file_review(self, ctx, file, fetched, results, skipped, failed):
+        '''Post a file's comments once all its chunks are reviewed, recording it as failed on errors'''
+        try:
+            comments = self.merge_file_review(file, fetched, results, skipped, failed)
+            if comments is not None:
+                ctx.create_file_comment(file.filename, comments)
+        except Exception as e:
+            print(f"Failed {file.filename} with error: {e}")
+            if file.filename not in failed:
+                failed.append(file.filename)
+
+    def review_by_files(self, ctx):
+        ctx.resolve()
+        files, skipped = self.triage_files(self.get_files_to_review(ctx, ctx.head_commit.files),
+                                           lambda file: self.file_triage.skip_path(file.filename))
+        if not files:
+            # the summary still lists what was skipped, and marks the head commit as reviewed
+            if skipped:
+                ctx.create_review(body=self.files_summary(0, skipped), event="COMMENT")
+            return
+        meme = self.start_meme()
+        triaged, failed = len(skipped), []
+        # comments are posted here in file order while the workers keep reviewing
+        for file, file_fetched, results in self.review_files(ctx, files):
+            self.post_file_review(ctx, file, file_fetched, results, skipped, failed)
+        reviewed = len(files) - (len(skipped) - triaged) - len(failed)
+        self.add_review_meme(ctx, self.files_summary(reviewed, skipped, failed), meme, marker=not failed)
+
+    async def areview_by_files(self, ctx):
+        '''review_by_files with max_workers concurrent requests on the event loop instead of threads'''
+        # PyGithub objects are resolved once up front, off the event loop
+        await asyncio.to_thread(ctx.resolve)
+        files = await asyncio.to_thread(self.get_files_to_review, ctx, ctx.head_commit.files)
+        files, skipped = self.triage_files(files, lambda file: self.file_triage.skip_path(file.filename))
+        if not files:
+            if skipped:
+                await ctx.acreate_review(body=self.files_summary(0, skipped), event="COMMENT")
             return
-        print(res)
-        prompt, image_url = res
-        pr.create_review(list(pr.get_commits())[-1], body=f"Great work! Here's a congratulatory AI generated meme!\n\n ![meme]({image_url})",
-                         event="COMMENT")
-
-    def review_by_files(self, pr):
-        repo = self.github_client.get_repo(os.getenv("GITHUB_REPOSITORY"))
-        latest_commit = list(pr.get_commits())[-1]
-        for file in latest_commit.files:
+        meme = self.start_meme()
+        # as in review_files, the reviews never wait behind the fetches of the later files
+        fetching = asyncio.Semaphore(max(1, self.max_workers))
+        reviewing = asyncio.Semaphore(max(1, self.max_workers))
+
+        async def review_file(file):
+            async with fetching:
+                fetched = await self.afetch_file_chunks(ctx, file)
+            chunks = fetched[2] if fetched else []
+
+            async def review_chunk(chunk):
+                async with reviewing:
+                    return (await self.areview_file_contents(ctx, file, chunk))[1]
+
+            return fetched, await asyncio.gather(*(review_chunk(chunk) for chunk in chunks))
+
+        tasks = [asyncio.create_task(review_file(file)) for file in files]
+        triaged, failed = len(skipped), []
+        # comments are posted here in file order while the other reviews keep running
+        for file, task in zip(files, tasks):
             try:
-                filename = file.filename
-                file_contents = repo.get_contents(filename, ref=latest_commit.sha).decoded_content
-                prompt = self.openai_client.get_file_prompt_contents(pr.title, pr.body, filename, file_contents)
-                comments = self.get_file_comments(prompt)
-                print("-----")
-                print(prompt)
-                print("-----")
-                print(comments)
+                file_fetched, results = await task
+                comments = self.merge_file_review(file, file_fetched, results, skipped, failed)
                 if comments is not None:
-                    pr.create_review_comment(body=comments, commit=latest_commit, path=filename, subject_type="file")
+                    await ctx.acreate_file_comment(file.filename, comments)
             except Exception as e:
-                print(f"Failed {filename} with error: {e}")
-        self.add_review_meme(pr)
+                print(f"Failed {file.filename} with error: {e}")
+                if file.filename not in failed:
+                    failed.append(file.filename)
+        reviewed = len(files) - (len(skipped) - triaged) - len(failed)
+        await self.aadd_review_meme(ctx, self.files_summary(reviewed, skipped, failed), meme, marker=not failed)
 
-    def review_pr(self, payload):
+    def review_pr(self, payload, repo_name=None):
         '''Review a PR'''
-        pr, changes = self.get_pull_request(payload)
-        self.review_by_files(pr)
-
-    def submit_pr_comment(self, pr, filename, severity, line, body):
-        content = f"""Severity: {severity}\nLine: {line}\n\n{body}"""
-        # if line < 0:
-        return pr.create_review_comment(body=content,
-                                 commit=list(pr.get_commits())[-1],
-                                 path=filename,
-                                 subject_type="file")
-        # else:
-        #     return pr.create_review_comment(body=content,
-        #                              commit=list(pr.get_commits())[-1],
-        #                              path=filename,
-        #                              line=line)
+        ctx = self.get_pull_request(payload, repo_name)
+        try:
+            self.review(ctx)
+        finally:
+            self.write_report()
+
+    def review(self, ctx):
+        '''Review the pull request of ctx, adding its GitHub API calls to the run metrics'''
+        try:
+            if self.review_mode == "issues":
+                self.review_by_issues(ctx)
+            elif self.async_transport:
+                asyncio.run(self.areview(ctx))
+            else:
+                self.review_by_files(ctx)
+        finally:
+            self.metrics.count("github_api_calls", ctx.api_calls)
+            print(f"GitHub API calls for {ctx.repo_name}#{ctx.payload.get('number')}: {ctx.api_calls}")
+
+    async def areview(self, ctx):
+        '''Review with the GitHub and OpenAI calls sharing one pooled aiohttp session'''
+        async with AsyncTransport(limit=max(10, 2 * self.max_workers),
+                                  on_response=self.openai_client.update_rate_limits) as transport:
+            openai.aiosession.set(transport.session)
+            ctx.github_api = AsyncGithubAPI(transport.session, self.github_token)
+            await self.areview_by_files(ctx)
+
+    def write_report(self):
+        '''Write the run report and the job summary'''
+        self.metrics.count("cache_hits", self.completion_cache.hits)
+        self.metrics.count("cache_misses", self.completion_cache.misses)
+        print(f"Completion cache hits: {self.completion_cache.hits}, misses: {self.completion_cache.misses}")
+        try:
+            if self.report_path:
+                self.metrics.write_report(self.report_path)
+            self.metrics.write_summary()
+        except OSError as e:
+            print(f"Failed to write the run report with error: {e}")
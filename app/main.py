@@ -3,9 +3,10 @@
 #
 import json
 import os
+import sys
 import argparse
-import completion
-import githubs
+import events
+import metrics
 
 
 # Check required environment variables
@@ -31,32 +32,133 @@ parser.add_argument("--frequency-penalty",
 parser.add_argument("--presence-penalty",
                     help="Presence penalty for the model",
                     type=int, default=0)
+parser.add_argument("--max-tokens",
+                    help="Context window of the model in tokens, 0 to look it up by the model name",
+                    type=int, default=0)
+parser.add_argument("--max-workers",
+                    help="Number of files reviewed concurrently",
+                    type=int, default=1)
+parser.add_argument("--requests-per-minute",
+                    help="OpenAI requests per minute limit, 0 for unlimited",
+                    type=int, default=0)
+parser.add_argument("--tokens-per-minute",
+                    help="OpenAI tokens per minute limit, 0 for unlimited",
+                    type=int, default=0)
+parser.add_argument("--cache-path",
+                    help="Path of the completion cache database, empty to disable caching",
+                    type=str, default="")
+parser.add_argument("--cache-size",
+                    help="Maximum size of the completion cache in MB",
+                    type=int, default=64)
+parser.add_argument("--incremental",
+                    help="Only review the changes since the last reviewed commit",
+                    type=lambda value: value.lower() == "true", default=False)
+parser.add_argument("--async-transport",
+                    help="Make the GitHub and OpenAI calls over one pooled async HTTP session",
+                    type=lambda value: value.lower() == "true", default=False)
+parser.add_argument("--report-path",
+                    help="Path of the JSON run report, empty to only write the job summary",
+                    type=str, default="")
+parser.add_argument("--include",
+                    help="Comma separated globs of the files to review, empty for all files",
+                    type=str, default="")
+parser.add_argument("--exclude",
+                    help="Comma separated globs of the files not to review",
+                    type=str, default="")
+parser.add_argument("--context-tokens",
+                    help="Token budget of the changed parts of a file and their enclosing functions and classes, 0 to review whole files",
+                    type=int, default=2000)
+parser.add_argument("--review-mode",
+                    help="files to comment on each file, issues to post the findings on their lines in a single review",
+                    type=str, choices=["files", "issues"], default="files")
+parser.add_argument("--max-file-size",
+                    help="Maximum size in KB of a reviewed file or patch",
+                    type=int, default=256)
+parser.add_argument("--meme",
+                    help="Add a generated meme to the review summary",
+                    type=lambda value: value.lower() == "true", default=True)
+parser.add_argument("--meme-timeout",
+                    help="Seconds to wait for the meme once the files are reviewed",
+                    type=float, default=10)
+parser.add_argument("--meme-max-age",
+                    help="Seconds a generated meme is reused for, OpenAI image URLs expire after an hour",
+                    type=int, default=3000)
+parser.add_argument("--meme-pool-size",
+                    help="Memes generated before they are reused across seeds",
+                    type=int, default=5)
+parser.add_argument("--jobs",
+                    help="Batch mode: JSONL file of {\"repo\": ..., \"number\": ...} pull requests to review, - for stdin",
+                    type=str, default="")
+parser.add_argument("--batch-concurrency",
+                    help="Batch mode: number of pull requests reviewed concurrently",
+                    type=int, default=4)
+parser.add_argument("--checkpoint-path",
+                    help="Batch mode: file recording the reviewed pull requests, to resume after a restart",
+                    type=str, default="")
 args = parser.parse_args()
 
 
-# Initialize clients
+# Load github workflow event
+run_metrics = metrics.RunMetrics()
+if not args.jobs:
+    with run_metrics.stage("event parse"):
+        with open(os.getenv("GITHUB_EVENT_PATH", '/github/workflow/event.json'), encoding='utf-8') as ev:
+            payload = json.load(ev)
+        eventType = events.get_event_type(payload)
+    print(f"Evaluating {eventType} event")
+    if eventType != events.EVENT_TYPE_PULL_REQUEST:
+        print(f"{eventType} event is not supported yet, skipping")
+        exit(0)
+
+
+# Initialize clients, only imported once there is work to do as they are slow to load
+import cache  # noqa: E402
+import completion  # noqa: E402
+import githubs  # noqa: E402
+import triage  # noqa: E402
+
 openai_client = completion.OpenAIClient(
     model=args.model,
     temperature=args.temperature,
     frequency_penalty=args.frequency_penalty,
-    presence_penalty=args.presence_penalty)
+    presence_penalty=args.presence_penalty,
+    max_tokens=args.max_tokens,
+    requests_per_minute=args.requests_per_minute,
+    tokens_per_minute=args.tokens_per_minute,
+    metrics=run_metrics)
 github_client = githubs.GithubClient(
     openai_client=openai_client,
     review_per_file=True,
     comment_per_file=False,
-    blocking=False)
+    blocking=False,
+    max_workers=args.max_workers,
+    completion_cache=cache.open_cache(args.cache_path, args.cache_size * 1024 * 1024),
+    incremental=args.incremental,
+    async_transport=args.async_transport,
+    context_tokens=args.context_tokens,
+    meme=args.meme,
+    meme_timeout=args.meme_timeout,
+    meme_max_age=args.meme_max_age,
+    meme_pool_size=args.meme_pool_size,
+    review_mode=args.review_mode,
+    report_path=args.report_path,
+    file_triage=triage.FileTriage(
+        include=[glob.strip() for glob in args.include.split(",") if glob.strip()],
+        exclude=[glob.strip() for glob in args.exclude.split(",") if glob.strip()],
+        max_bytes=args.max_file_size * 1024))
 
 
-# Load github workflow event
-with open('/github/workflow/event.json', encoding='utf-8') as ev:
-    payload = json.load(ev)
-eventType = github_client.get_event_type(payload)
-print(f"Evaluating {eventType} event")
+# Review the queued pull requests in batch mode
+if args.jobs:
+    import batch  # noqa: E402
+    reviewer = batch.BatchReviewer(github_client, args.batch_concurrency, args.checkpoint_path)
+    if args.jobs == "-":
+        reviewer.run(sys.stdin)
+    else:
+        with open(args.jobs, encoding='utf-8') as jobs:
+            reviewer.run(jobs)
+    exit(0)
 
 
 # Review the changes via ChatGPT
-match eventType:
-    case githubs.EVENT_TYPE_PULL_REQUEST:
-        github_client.review_pr(payload)
-    case _:
-        print(f"{eventType} event is not supported yet, skipping")
+github_client.review_pr(payload)
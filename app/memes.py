@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+import json
+import random
+import threading
+import time
+from concurrent.futures import Future
+from cache import content_hash
+
+
+# OpenAI image URLs expire an hour after generation
+DEFAULT_MAX_AGE = 50 * 60
+# Memes generated before any is reused for another seed
+DEFAULT_POOL_SIZE = 5
+
+
+def run_in_background(func) -> Future:
+    '''Run func on a daemon thread, so a slow call can never hold the process at exit'''
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(func())
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+class MemePool:
+    '''Generated memes by seed emoji, reused until they expire.
+
+    A seed reuses its own memes. Other seeds get a new meme until the pool
+    holds size of them, and then reuse any of those. The pool is kept in the completion cache backend, so runs restoring the
+    cache share it, and in memory for the later reviews of a batch.
+    '''
+
+    def __init__(self, backend, max_age=DEFAULT_MAX_AGE, size=DEFAULT_POOL_SIZE):
+        self.backend = backend
+        self.max_age = max_age
+        self.size = size
+        self.memes = None
+        self.lock = threading.Lock()
+
+    def key(self) -> str:
+        return content_hash("meme")
+
+    def fresh(self) -> dict:
+        '''The memes that have not expired, by seed'''
+        with self.lock:
+            memes = self.memes
+            if memes is None:
+                value = self.backend.get(self.key())
+                memes = json.loads(value) if value else {}
+            now = time.time()
+            memes = {seed: [meme for meme in seed_memes if now - meme["created"] < self.max_age]
+                     for seed, seed_memes in memes.items()}
+            self.memes = {seed: seed_memes for seed, seed_memes in memes.items() if seed_memes}
+            return dict(self.memes)
+
+    def get(self, seed):
+        '''A pooled (prompt, image URL) for seed, None while a new meme should be generated'''
+        memes = self.fresh()
+        candidates = memes.get(seed)
+        if not candidates:
+            candidates = [meme for seed_memes in memes.values() for meme in seed_memes]
+            if len(candidates) < self.size:
+                return None
+        meme = random.choice(candidates)
+        return meme["prompt"], meme["url"]
+
+    def add(self, seed, prompt, url):
+        memes = self.fresh()
+        memes[seed] = memes.get(seed, []) + [{"prompt": prompt, "url": url, "created": time.time()}]
+        with self.lock:
+            self.memes = memes
+            self.backend.set(self.key(), json.dumps(memes))
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# USD per 1K (prompt, completion) tokens, matched by longest model name prefix
+MODEL_PRICES = {
+    "gpt-4-32k": (0.06, 0.12),
+    "gpt-4": (0.03, 0.06),
+    "gpt-35-turbo-16k": (0.003, 0.004),
+    "gpt-35-turbo": (0.0015, 0.002),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+    "gpt-3.5-turbo": (0.0015, 0.002),
+}
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens) -> float:
+    '''Estimated USD cost of a completion, 0 for models without a known price'''
+    prefixes = [prefix for prefix in MODEL_PRICES if model.startswith(prefix)]
+    if not prefixes:
+        return 0
+    prompt_price, completion_price = MODEL_PRICES[max(prefixes, key=len)]
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+
+class RunMetrics:
+    '''Thread-safe timings, token counts and costs of a run, per stage and per file'''
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = {}
+        self.files = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        # a context variable rather than a thread local, so it also works across asyncio tasks
+        self.path = contextvars.ContextVar("metrics_path", default=None)
+
+    @contextmanager
+    def file(self, path):
+        '''Attribute what the current thread or task records to path'''
+        token = self.path.set(path)
+        try:
+            yield
+        finally:
+            self.path.reset(token)
+
+    def file_entry(self, path=None):
+        path = path or self.path.get()
+        if path is None:
+            return None
+        return self.files.setdefault(path, {
+            "seconds": 0, "completions": 0, "retries": 0,
+            "prompt_tokens": 0, "completion_tokens": 0, "cost": 0,
+        })
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            stage = self.stages.setdefault(name, {"seconds": 0, "count": 0})
+            stage["seconds"] += seconds
+            stage["count"] += 1
+
+    @contextmanager
+    def stage(self, name):
+        '''Time a block as one occurrence of the named stage'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            if name == "retries":
+                entry = self.file_entry()
+                if entry is not None:
+                    entry["retries"] += value
+
+    def add_completion(self, model, seconds, prompt_tokens, completion_tokens):
+        '''Record one completion against the stage totals and the current file'''
+        cost = estimate_cost(model, prompt_tokens, completion_tokens)
+        self.add_time("openai completion", seconds)
+        with self.lock:
+            for name, value in (("prompt_tokens", prompt_tokens),
+                                ("completion_tokens", completion_tokens),
+                                ("cost", cost)):
+                self.counters[name] = self.counters.get(name, 0) + value
+            entry = self.file_entry()
+            if entry is not None:
+                entry["seconds"] += seconds
+                entry["completions"] += 1
+                entry["prompt_tokens"] += prompt_tokens
+                entry["completion_tokens"] += completion_tokens
+                entry["cost"] += cost
+
+    def report(self) -> dict:
+        with self.lock:
+            return {
+                "wall_seconds": time.time() - self.started,
+                "stages": dict(self.stages),
+                "counters": dict(self.counters),
+                "files": dict(self.files),
+            }
+
+    def write_report(self, path):
+        '''Write the run report as JSON'''
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=2)
+
+    def summary(self) -> str:
+        '''Markdown summary of the run report'''
+        report = self.report()
+        counters = report["counters"]
+        lines = [
+            "### ChatGPT Reviewer",
+            "",
+            f"Wall time: {report['wall_seconds']:.1f}s, "
+            f"tokens: {counters.get('prompt_tokens', 0)} prompt + {counters.get('completion_tokens', 0)} completion, "
+            f"estimated cost: ${counters.get('cost', 0):.4f}",
+            "",
+            "|Stage|Count|Seconds|",
+            "|-----|-----|-------|",
+        ]
+        for name, stage in report["stages"].items():
+            lines.append(f"|{name}|{stage['count']}|{stage['seconds']:.2f}|")
+        if report["files"]:
+            lines += ["", "|File|Completions|Retries|Seconds|Tokens|Cost|",
+                      "|----|-----------|-------|-------|------|----|"]
+            for path, entry in sorted(report["files"].items(), key=lambda item: -item[1]["seconds"]):
+                tokens = entry["prompt_tokens"] + entry["completion_tokens"]
+                lines.append(f"|{path}|{entry['completions']}|{entry['retries']}|"
+                             f"{entry['seconds']:.2f}|{tokens}|${entry['cost']:.4f}|")
+        return "\n".join(lines) + "\n"
+
+    def write_summary(self):
+        '''Append the summary to the GitHub Actions job summary, when running in Actions'''
+        path = os.getenv("GITHUB_STEP_SUMMARY")
+        if not path:
+            return
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(self.summary())
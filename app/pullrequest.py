@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+import math
+import re
+import threading
+from functools import cached_property
+import requests
+from github import GithubException
+
+
+# Hidden marker recording the head commit in the body of every review posted
+REVIEW_MARKER = "<!-- chatgpt-reviewer:sha={sha} -->"
+REVIEW_MARKER_PATTERN = re.compile(r"<!-- chatgpt-reviewer:sha=([0-9a-f]+) -->")
+# Account posting the reviews with an installation token such as GITHUB_TOKEN
+ACTIONS_BOT_LOGIN = "github-actions[bot]"
+
+
+class PullRequestContext:
+    '''Lazily resolved GitHub state of the pull request under review.
+
+    Every object is fetched at most once per run and shared by all review
+    paths. api_calls counts the GitHub requests issued through the context.
+    '''
+
+    def __init__(self, github_client, github_token, repo_name, payload, metrics, http=None):
+        self.github_client = github_client
+        self.metrics = metrics
+        self.github_token = github_token
+        self.repo_name = repo_name
+        self.payload = payload
+        self.http = http or requests
+        # AsyncGithubAPI used by the a* methods, set by the async review path
+        self.github_api = None
+        self.api_calls = 0
+        self.lock = threading.Lock()
+
+    def count(self, calls=1):
+        with self.lock:
+            self.api_calls += calls
+
+    def count_pages(self, items):
+        '''Count the requests needed to walk a paginated list of items'''
+        per_page = self.github_client.per_page
+        self.count(max(1, math.ceil(len(items) / per_page)))
+
+    @cached_property
+    def repo(self):
+        self.count()
+        with self.metrics.stage("github fetch"):
+            return self.github_client.get_repo(self.repo_name)
+
+    @cached_property
+    def pr(self):
+        repo = self.repo
+        self.count()
+        with self.metrics.stage("github fetch"):
+            return repo.get_pull(self.payload.get("number"))
+
+    @cached_property
+    def head_sha(self) -> str:
+        '''Head commit SHA, from the event payload when it is there'''
+        head = (self.payload.get("pull_request") or {}).get("head") or {}
+        if head.get("sha"):
+            return head["sha"]
+        return self.pr.head.sha
+
+    @cached_property
+    def head_commit(self):
+        repo, head_sha = self.repo, self.head_sha
+        self.count()
+        with self.metrics.stage("github fetch"):
+            return repo.get_commit(head_sha)
+
+    @cached_property
+    def files(self) -> list:
+        '''Files changed by the whole pull request'''
+        pr = self.pr
+        with self.metrics.stage("github fetch"):
+            files = list(pr.get_files())
+        self.count_pages(files)
+        return files
+
+    @cached_property
+    def diff(self) -> str:
+        '''Raw diff of the whole pull request'''
+        pr = self.pr
+        self.count()
+        with self.metrics.stage("github fetch"):
+            return self.http.get(pr.url,
+                                timeout=30,
+                                headers={"Authorization": "Bearer " + self.github_token,
+                                         "Accept": "application/vnd.github.v3.diff"},
+                                ).text
+
+    @cached_property
+    def reviewer_login(self) -> str:
+        '''Login of the account the reviews are posted with'''
+        self.count()
+        try:
+            with self.metrics.stage("github fetch"):
+                return self.github_client.get_user().login
+        except GithubException:
+            # installation tokens cannot read the authenticated user
+            return ACTIONS_BOT_LOGIN
+
+    @cached_property
+    def last_reviewed_sha(self):
+        '''Head commit of our most recent review carrying the marker, None if there is none'''
+        pr, login = self.pr, self.reviewer_login
+        with self.metrics.stage("github fetch"):
+            reviews = list(pr.get_reviews())
+        self.count_pages(reviews)
+        for review in reversed(reviews):
+            # anyone can post the marker, only our own reviews are trusted
+            if review.user is None or review.user.login != login:
+                continue
+            match = REVIEW_MARKER_PATTERN.search(review.body or "")
+            if match:
+                return match.group(1)
+        return None
+
+    def compare_files(self, base_sha):
+        '''Files changed between base_sha and the head commit.
+
+        Returns None when the head does not descend from base_sha, e.g. after
+        a force-push, so the caller can fall back to a full review.
+        '''
+        repo = self.repo
+        self.count()
+        try:
+            with self.metrics.stage("github fetch"):
+                comparison = repo.compare(base_sha, self.head_sha)
+        except GithubException as e:
+            print(f"Failed to compare {base_sha}...{self.head_sha} with error: {e}")
+            return None
+        if comparison.status != "ahead":
+            return None
+        # the compare response carries the changed files, no extra requests needed
+        return list(comparison.files)
+
+    def resolve(self):
+        '''Resolve the objects shared by the review workers before they start'''
+        return self.pr, self.head_commit
+
+    def get_contents(self, path) -> bytes:
+        '''File contents at the head commit'''
+        repo = self.repo
+        self.count()
+        with self.metrics.stage("github fetch"):
+            return repo.get_contents(path, ref=self.head_sha).decoded_content
+
+    def review_body(self, body, marker) -> str:
+        '''Review body, with the marker recording the head commit as reviewed if marker is set'''
+        return f"{body}\n\n{REVIEW_MARKER.format(sha=self.head_sha)}" if marker else body
+
+    def create_review(self, body, event, comments=None, marker=True):
+        pr, head_commit = self.pr, self.head_commit
+        body = self.review_body(body, marker)
+        self.count()
+        with self.metrics.stage("comment posting"):
+            return pr.create_review(head_commit, body=body, event=event,
+                                    comments=comments or [])
+
+    def create_file_comment(self, path, body):
+        pr, head_commit = self.pr, self.head_commit
+        self.count()
+        with self.metrics.stage("comment posting"):
+            return pr.create_review_comment(body=body, commit=head_commit,
+                                            path=path, subject_type="file")
+
+    async def aget_contents(self, path) -> bytes:
+        '''File contents at the head commit, over the async transport'''
+        self.count()
+        with self.metrics.stage("github fetch"):
+            return await self.github_api.get_contents(self.repo_name, path, self.head_sha)
+
+    async def acreate_review(self, body, event, comments=None, marker=True):
+        body = self.review_body(body, marker)
+        self.count()
+        with self.metrics.stage("comment posting"):
+            return await self.github_api.create_review(self.repo_name, self.payload.get("number"),
+                                                       self.head_sha, body, event, comments)
+
+    async def acreate_file_comment(self, path, body):
+        self.count()
+        with self.metrics.stage("comment posting"):
+            return await self.github_api.create_file_comment(self.repo_name, self.payload.get("number"),
+                                                             self.head_sha, path, body)
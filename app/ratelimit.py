@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+import asyncio
+import re
+import threading
+import time
+
+
+DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value) -> float:
+    '''Seconds in an OpenAI reset duration such as "6m0s", "1.5s" or "20ms"'''
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in DURATION.findall(value or ""))
+
+
+class TokenBucket:
+    '''Token bucket refilled continuously at capacity per minute'''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.available = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        elapsed = now - self.updated
+        self.available = min(self.capacity, self.available + elapsed * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount) -> float:
+        '''Seconds until amount can be taken, 0 if it can be taken now'''
+        # a single request larger than the bucket waits for a full bucket only
+        amount = min(amount, self.capacity)
+        if self.available >= amount:
+            return 0
+        return (amount - self.available) * 60 / self.capacity
+
+
+class RateLimiter:
+    '''Thread-safe requests-per-minute and tokens-per-minute limiter.
+
+    A limit of 0 starts disabled, until update() learns it from the
+    x-ratelimit-* headers of a response. The headers also keep the local
+    budgets in line with what the server reports as remaining, and a
+    response without quota left holds every caller until its reset.
+    '''
+
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0):
+        self.buckets = {}
+        if requests_per_minute > 0:
+            self.buckets["requests"] = TokenBucket(requests_per_minute)
+        if tokens_per_minute > 0:
+            self.buckets["tokens"] = TokenBucket(tokens_per_minute)
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def update(self, headers):
+        '''Sync the budgets with the rate limit headers of a response'''
+        with self.lock:
+            now = time.monotonic()
+            for name in ("requests", "tokens"):
+                remaining = headers.get(f"x-ratelimit-remaining-{name}")
+                if remaining is None:
+                    continue
+                remaining = int(remaining)
+                limit = headers.get(f"x-ratelimit-limit-{name}")
+                bucket = self.buckets.get(name)
+                if bucket is None and limit is not None and int(limit) > 0:
+                    bucket = self.buckets[name] = TokenBucket(int(limit))
+                if bucket is None:
+                    continue
+                bucket.refill(now)
+                bucket.available = min(bucket.available, remaining)
+                if remaining <= 0:
+                    reset = parse_duration(headers.get(f"x-ratelimit-reset-{name}"))
+                    self.blocked_until = max(self.blocked_until, now + reset)
+
+            if headers.get("retry-after-ms") is not None:
+                retry_after = float(headers["retry-after-ms"]) / 1000
+            else:
+                retry_after = float(headers.get("retry-after") or 0)
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+
+    def reserve(self, tokens) -> float:
+        '''Take one request of the given token cost if it fits now, else return the seconds to wait'''
+        cost = {"requests": 1, "tokens": tokens}
+        with self.lock:
+            now = time.monotonic()
+            wait = max(0, self.blocked_until - now)
+            for name, bucket in self.buckets.items():
+                bucket.refill(now)
+                wait = max(wait, bucket.wait_time(cost[name]))
+            if wait == 0:
+                for name, bucket in self.buckets.items():
+                    bucket.available -= min(cost[name], bucket.capacity)
+            return wait
+
+    def acquire(self, tokens=0):
+        '''Block until one request of the given token cost fits in both budgets'''
+        while True:
+            wait = self.reserve(tokens)
+            if wait == 0:
+                return
+            time.sleep(wait)
+
+    async def aacquire(self, tokens=0):
+        '''Wait without blocking the event loop until one request of the given token cost fits'''
+        while True:
+            wait = self.reserve(tokens)
+            if wait == 0:
+                return
+            await asyncio.sleep(wait)
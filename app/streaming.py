@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+import json
+
+
+class IssueStreamParser:
+    '''Incrementally parse raise_issues arguments, {"data": [{...}, ...]}, as they stream in.
+
+    feed() returns the issues completed by the new text, so each one can be
+    handled before the rest of the arguments have been generated.
+    '''
+
+    def __init__(self):
+        self.buffer = ""
+        self.position = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.start = None
+
+    def feed(self, text) -> list:
+        issues = []
+        self.buffer += text
+        while self.position < len(self.buffer):
+            char = self.buffer[self.position]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.depth += 1
+                # depth 1 is the arguments object and 2 the data array, so 3 is an issue
+                if self.depth == 3 and char == "{":
+                    self.start = self.position
+            elif char in "}]":
+                if self.depth == 3 and self.start is not None:
+                    issues.extend(self.parse(self.buffer[self.start:self.position + 1]))
+                    self.start = None
+                self.depth -= 1
+            self.position += 1
+
+        # only the issue still being generated needs to be kept around
+        keep = self.start if self.start is not None else self.position
+        self.buffer = self.buffer[keep:]
+        self.position -= keep
+        if self.start is not None:
+            self.start = 0
+        return issues
+
+    def parse(self, text) -> list:
+        try:
+            issue = json.loads(text)
+        except json.JSONDecodeError as e:
+            print(f"Skipping malformed issue {text} with error {e}")
+            return []
+        return [issue] if isinstance(issue, dict) else []
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+import os
+from urllib.parse import quote
+import aiohttp
+
+
+class AsyncTransport:
+    '''Keep-alive connection pool shared by the async GitHub and OpenAI calls.
+
+    on_response(url, headers) is called for every response, which lets the
+    OpenAI client keep feeding its rate limiter from the response headers.
+    '''
+
+    def __init__(self, limit=100, keepalive_timeout=30, on_response=None):
+        self.limit = limit
+        self.keepalive_timeout = keepalive_timeout
+        self.on_response = on_response
+        self.session = None
+
+    async def __aenter__(self):
+        trace_config = aiohttp.TraceConfig()
+        if self.on_response is not None:
+            async def on_request_end(session, context, params):
+                self.on_response(str(params.url), params.response.headers)
+            trace_config.on_request_end.append(on_request_end)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=self.keepalive_timeout),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=100),
+            trace_configs=[trace_config])
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+
+class AsyncGithubAPI:
+    '''The few GitHub REST calls a review makes, over an aiohttp session'''
+
+    def __init__(self, session, github_token, base_url=None):
+        self.session = session
+        self.base_url = (base_url or os.getenv("GITHUB_API_URL") or "https://api.github.com").rstrip("/")
+        self.headers = {
+            "Authorization": f"Bearer {github_token}",
+            "Accept": "application/vnd.github+json",
+            "X-GitHub-Api-Version": "2022-11-28",
+        }
+
+    async def request(self, method, path, accept=None, **kwargs):
+        headers = dict(self.headers)
+        if accept is not None:
+            headers["Accept"] = accept
+        async with self.session.request(method, f"{self.base_url}{path}", headers=headers, **kwargs) as response:
+            response.raise_for_status()
+            if accept is not None:
+                return await response.read()
+            return await response.json()
+
+    async def get_contents(self, repo, path, ref) -> bytes:
+        '''Raw file contents at ref'''
+        return await self.request("GET", f"/repos/{repo}/contents/{quote(path)}",
+                                  accept="application/vnd.github.raw", params={"ref": ref})
+
+    async def create_review(self, repo, number, commit_id, body, event, comments=None):
+        return await self.request("POST", f"/repos/{repo}/pulls/{number}/reviews", json={
+            "commit_id": commit_id,
+            "body": body,
+            "event": event,
+            "comments": comments or [],
+        })
+
+    async def create_file_comment(self, repo, number, commit_id, path, body):
+        return await self.request("POST", f"/repos/{repo}/pulls/{number}/comments", json={
+            "commit_id": commit_id,
+            "path": path,
+            "body": body,
+            "subject_type": "file",
+        })
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+import os
+import re
+from fnmatch import fnmatch
+
+
+# Generated and vendored paths, in the spirit of linguist's generated.rb and vendor.yml
+GENERATED_PATTERNS = [
+    "package-lock.json", "npm-shrinkwrap.json", "yarn.lock", "pnpm-lock.yaml",
+    "Cargo.lock", "Gemfile.lock", "poetry.lock", "Pipfile.lock", "composer.lock",
+    "go.sum", "*.min.js", "*.min.css", "*.map", "*.snap", "*.pb.go", "*_pb2.py",
+    "*_pb2_grpc.py", "*.generated.*", "*.g.dart", "*.designer.cs",
+]
+VENDORED_DIRECTORIES = [
+    "vendor", "node_modules", "third_party", "third-party", "bower_components",
+    "__snapshots__", "dist",
+]
+# Header comments of generated files, in the spirit of linguist's generated.rb
+GENERATED_COMMENT = r"^\s*(?://+|#+|/?\*+|--|;+|<!--)\s*"
+GENERATED_HEADERS = [re.compile(GENERATED_COMMENT + pattern, re.IGNORECASE) for pattern in (
+    r"Code generated .* DO NOT EDIT\.?",
+    r"Generated by .*DO NOT EDIT",
+    r".*@generated\b",
+    r"(?:This (?:file|code) (?:is|was|has been) )?(?:auto-?generated|automatically generated)\b",
+)]
+# Generated file headers are expected in the first few lines only
+GENERATED_HEADER_LINES = 5
+
+# Minified files are made of a few very long lines
+MINIFIED_LINE_LENGTH = 500
+
+
+def matches(path, pattern) -> bool:
+    '''Match a path against a glob, patterns without a slash also match the file name'''
+    if fnmatch(path, pattern):
+        return True
+    return "/" not in pattern and fnmatch(os.path.basename(path), pattern)
+
+
+def decode_text(contents):
+    '''Decode file contents as text, None for binary contents.
+
+    As git does, contents with a NUL byte in their first 8000 bytes are binary.
+    Text that is not UTF-8 is decoded as Latin-1, which cannot fail.
+    '''
+    if b"\0" in contents[:8000]:
+        return None
+    try:
+        return contents.decode("utf-8")
+    except UnicodeDecodeError:
+        return contents.decode("latin-1")
+
+
+def format_skipped(skipped) -> str:
+    '''Markdown list of the skipped (path, reason) pairs for the review summary'''
+    if not skipped:
+        return ""
+    lines = [f"- `{path}`: {reason}" for path, reason in skipped]
+    return "Skipped files:\n" + "\n".join(lines)
+
+
+def format_failed(failed) -> str:
+    '''Markdown list of the paths that failed to be reviewed for the review summary'''
+    if not failed:
+        return ""
+    lines = [f"- `{path}`" for path in failed]
+    return "Failed to review, retried on the next review:\n" + "\n".join(lines)
+
+
+class FileTriage:
+    '''Decide which files are worth sending to the model'''
+
+    def __init__(self, include=None, exclude=None, max_bytes=256 * 1024):
+        self.include = include or []
+        self.exclude = exclude or []
+        self.max_bytes = max_bytes
+
+    def skip_path(self, path):
+        '''Reason to skip a file by its path alone, None to review it'''
+        if self.include and not any(matches(path, pattern) for pattern in self.include):
+            return "not included"
+        if any(matches(path, pattern) for pattern in self.exclude):
+            return "excluded"
+        if any(matches(path, pattern) for pattern in GENERATED_PATTERNS):
+            return "generated"
+        if any(part in VENDORED_DIRECTORIES for part in path.split("/")[:-1]):
+            return "vendored"
+        return None
+
+    def skip_patch(self, file):
+        '''Reason to skip a file by its patch, None to review it'''
+        reason = self.skip_path(file.filename)
+        if reason is not None:
+            return reason
+        if not file.patch:
+            # GitHub leaves the patch out for binary and very large diffs
+            return "binary or too large"
+        if len(file.patch.encode("utf-8")) > self.max_bytes:
+            return "too large"
+        return None
+
+    def skip_contents(self, contents, text):
+        '''Reason to skip a file by its contents, None to review it. text is None for binary contents.'''
+        if text is None:
+            return "binary"
+        if len(contents) > self.max_bytes:
+            return "too large"
+        lines = text.splitlines()
+        if any(pattern.match(line) for line in lines[:GENERATED_HEADER_LINES] for pattern in GENERATED_HEADERS):
+            return "generated"
+        if lines and len(text) / len(lines) > MINIFIED_LINE_LENGTH:
+            return "minified"
+        return None
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Local stand-ins for the GitHub and OpenAI HTTP APIs, serving a PR fixture.
+#
+# A fixture is a JSON document:
+#
+#   {"repository": "owner/repo",
+#    "pull_request": {"number": 1, "title": "...", "body": "...", "head_sha": "..."},
+#    "files": [{"filename": "...", "status": "modified", "sha": "...",
+#               "patch": "@@ ...", "contents": "..."}],
+#    "completions": {"issues": [{"severity": 1, "line": 1, "body": "..."}],
+#                    "comments": "..."}}
+#
+# Only the endpoints the reviewer calls are implemented.
+import base64
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    # keep-alive, so connection reuse shows up in the timings
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def send(self, status, body, content_type="application/json", headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, method):
+        server = self.server.fake
+        url = urlsplit(self.path)
+        body = self.read_json() if method == "POST" else None
+        time.sleep(server.latency)
+        if server.rate_limited():
+            server.record("429")
+            self.send(429, {"error": {"message": "Rate limit reached", "type": "requests"}},
+                      headers={"retry-after-ms": str(server.retry_after_ms)})
+            return
+        route, response = server.route(method, url.path, parse_qs(url.query), self.headers, body)
+        server.record(route)
+        response(self)
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+
+class FakeServer:
+    '''Threaded HTTP server on a free local port, counting requests per route'''
+
+    def __init__(self, latency=0, rate_429=0, retry_after_ms=100, seed=0):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.retry_after_ms = retry_after_ms
+        self.random = random.Random(seed)
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), FakeHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def rate_limited(self) -> bool:
+        with self.lock:
+            return self.random.random() < self.rate_429
+
+    def record(self, route):
+        with self.lock:
+            self.requests[route] += 1
+
+    def route(self, method, path, query, headers, body):
+        '''(route name, callable writing the response to the handler)'''
+        raise NotImplementedError
+
+
+def reply(status, body, **kwargs):
+    return lambda handler: handler.send(status, body, **kwargs)
+
+
+class FakeGithub(FakeServer):
+    '''GitHub REST API serving one pull request'''
+
+    def __init__(self, fixture, **kwargs):
+        super().__init__(**kwargs)
+        self.fixture = fixture
+        self.files = {file["filename"]: file for file in fixture["files"]}
+        self.reviews = []
+        self.comments = []
+
+    def repo_json(self):
+        full_name = self.fixture["repository"]
+        owner, name = full_name.split("/")
+        return {"id": 1, "name": name, "full_name": full_name, "owner": {"login": owner},
+                "url": f"{self.url}/repos/{full_name}"}
+
+    def pull_json(self):
+        pr = self.fixture["pull_request"]
+        repo = self.repo_json()
+        return {"id": 1, "number": pr["number"], "title": pr["title"], "body": pr["body"],
+                "state": "open", "url": f"{repo['url']}/pulls/{pr['number']}",
+                "head": {"sha": pr["head_sha"], "ref": "feature"}, "base": {"sha": "0" * 40, "ref": "main"}}
+
+    def file_json(self, file):
+        lines = file["patch"].count("\n") + 1
+        return {"sha": file["sha"], "filename": file["filename"], "status": file["status"],
+                "additions": lines, "deletions": 0, "changes": lines, "patch": file["patch"]}
+
+    def route(self, method, path, query, headers, body):
+        repo = self.repo_json()
+        pull = self.pull_json()
+        prefix = f"/repos/{self.fixture['repository']}"
+        if method == "GET" and path == prefix:
+            return "repo", reply(200, repo)
+        if method == "GET" and path == f"{prefix}/pulls/{pull['number']}":
+            if "diff" in headers.get("Accept", ""):
+                diff = "\n".join(f"diff --git a/{name} b/{name}\n{file['patch']}" for name, file in self.files.items())
+                return "pull diff", reply(200, diff.encode("utf-8"), content_type="text/plain")
+            return "pull", reply(200, pull)
+        if method == "GET" and path == f"{prefix}/pulls/{pull['number']}/files":
+            return "pull files", self.paginate(path, query, [self.file_json(f) for f in self.files.values()])
+        if method == "GET" and path.startswith(f"{prefix}/commits/"):
+            return "commit", reply(200, {"sha": pull["head"]["sha"], "url": f"{repo['url']}/commits/{pull['head']['sha']}",
+                                         "files": [self.file_json(f) for f in self.files.values()]})
+        if method == "GET" and path.startswith(f"{prefix}/contents/"):
+            file = self.files.get(unquote(path[len(f"{prefix}/contents/"):]))
+            if file is None:
+                return "contents", reply(404, {"message": "Not Found"})
+            contents = file["contents"].encode("utf-8")
+            if "raw" in headers.get("Accept", ""):
+                return "contents", reply(200, contents, content_type="application/vnd.github.raw")
+            return "contents", reply(200, {"type": "file", "encoding": "base64", "size": len(contents),
+                                           "name": file["filename"].rsplit("/", 1)[-1], "path": file["filename"],
+                                           "sha": file["sha"], "content": base64.b64encode(contents).decode()})
+        if path == f"{prefix}/pulls/{pull['number']}/reviews":
+            if method == "POST":
+                with self.lock:
+                    self.reviews.append(dict(body, id=len(self.reviews) + 1, state="COMMENTED",
+                                             user={"login": "github-actions[bot]"}))
+                    review = self.reviews[-1]
+                return "create review", reply(200, review)
+            return "reviews", self.paginate(path, query, self.reviews)
+        if method == "POST" and path == f"{prefix}/pulls/{pull['number']}/comments":
+            with self.lock:
+                self.comments.append(dict(body, id=len(self.comments) + 1))
+                comment = self.comments[-1]
+            return "create comment", reply(201, comment)
+        return "not found", reply(404, {"message": "Not Found"})
+
+    def paginate(self, path, query, items):
+        page = int(query.get("page", ["1"])[0])
+        per_page = int(query.get("per_page", ["30"])[0])
+        headers = {}
+        if page * per_page < len(items):
+            headers["Link"] = f'<{self.url}{path}?page={page + 1}&per_page={per_page}>; rel="next"'
+        return reply(200, items[(page - 1) * per_page:page * per_page], headers=headers)
+
+
+class FakeOpenAI(FakeServer):
+    '''OpenAI API answering every completion with the fixture's canned response'''
+
+    def __init__(self, fixture, **kwargs):
+        super().__init__(**kwargs)
+        self.completions = fixture.get("completions", {})
+
+    def rate_limit_headers(self):
+        return {"x-ratelimit-limit-requests": "10000", "x-ratelimit-remaining-requests": "9999",
+                "x-ratelimit-limit-tokens": "10000000", "x-ratelimit-remaining-tokens": "9990000"}
+
+    def route(self, method, path, query, headers, body):
+        if method == "POST" and path.endswith("/chat/completions"):
+            prompt_tokens = sum(len(message["content"]) for message in body["messages"]) // 4
+            if body.get("functions"):
+                arguments = json.dumps({"data": self.issues(body["messages"][-1]["content"])})
+                message = {"role": "assistant", "content": None,
+                           "function_call": {"name": "raise_issues", "arguments": arguments}}
+                completion_tokens = len(arguments) // 4
+            else:
+                message = {"role": "assistant", "content": self.completions.get("comments", "LGTM")}
+                completion_tokens = len(message["content"]) // 4
+            if body.get("stream"):
+                return "chat stream", lambda handler: self.stream(handler, message)
+            return "chat", reply(200, {
+                "id": "chatcmpl-fake", "object": "chat.completion", "model": body.get("model"),
+                "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens},
+            }, headers=self.rate_limit_headers())
+        if method == "POST" and path.endswith("/images/generations"):
+            return "image", reply(200, {"created": 0, "data": [{"url": f"{self.url}/meme.png"}]})
+        return "not found", reply(404, {"error": {"message": "Not Found"}})
+
+    def issues(self, prompt) -> list:
+        '''The canned issues, on every file of the prompt when they have no path'''
+        issues = self.completions.get("issues", [])
+        paths = re.findall(r"diff --git a/\S+ b/(\S+)", prompt)
+        if not paths:
+            return issues
+        return [issue for issue in issues if "path" in issue] + \
+            [dict(issue, path=path) for path in paths for issue in issues if "path" not in issue]
+
+    def stream(self, handler, message):
+        '''Write the message as server-sent events, a few characters per chunk'''
+        if message.get("function_call"):
+            arguments = message["function_call"]["arguments"]
+            deltas = [{"role": "assistant", "function_call": {"name": "raise_issues", "arguments": ""}}]
+            deltas += [{"function_call": {"arguments": arguments[i:i + 16]}} for i in range(0, len(arguments), 16)]
+        else:
+            content = message["content"]
+            deltas = [{"role": "assistant", "content": ""}]
+            deltas += [{"content": content[i:i + 16]} for i in range(0, len(content), 16)]
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Transfer-Encoding", "chunked")
+        for name, value in self.rate_limit_headers().items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        events = [{"id": "chatcmpl-fake", "object": "chat.completion.chunk",
+                   "choices": [{"index": 0, "delta": delta, "finish_reason": None}]} for delta in deltas]
+        for event in [json.dumps(event) for event in events] + ["[DONE]"]:
+            data = f"data: {event}\n\n".encode("utf-8")
+            handler.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        handler.wfile.write(b"0\r\n\r\n")
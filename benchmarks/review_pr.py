@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# End-to-end benchmark of GithubClient.review_pr against local fake GitHub
+# and OpenAI servers, so it costs nothing and needs no network.
+#
+#   python benchmarks/review_pr.py --scenario small medium --max-workers 8 --openai-latency 0.5
+#   python benchmarks/review_pr.py --fixture recorded-pr.json --openai-429 0.1 --async-transport
+#
+# Scenarios are synthetic PRs, --fixture replays a recorded one instead (see
+# fake_servers.py for the format). The tokenizer is the real one, so
+# TIKTOKEN_CACHE_DIR must point at a warm cache to run offline.
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import random
+import string
+import sys
+import time
+
+from fake_servers import FakeGithub, FakeOpenAI
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+
+# (files, lines per file, changed lines per file)
+SCENARIOS = {
+    "small": (3, 80, 20),
+    "medium": (25, 400, 60),
+    "huge": (150, 3000, 400),
+}
+
+
+def synthetic_file(rnd, lines) -> str:
+    '''Python-like source with a function every 20 lines'''
+    out = []
+    for i in range(lines):
+        word = ''.join(rnd.choices(string.ascii_lowercase, k=rnd.randint(3, 12)))
+        if i % 20 == 0:
+            out.append(f"def {word}_{i}(value):")
+        else:
+            out.append(f"    {word} = value + {rnd.randint(0, 1 << 16)}  # {word}")
+    return "\n".join(out) + "\n"
+
+
+def synthetic_fixture(name, seed=0) -> dict:
+    '''A PR adding changed lines at the end of each file, with canned completions'''
+    files, lines, changed = SCENARIOS[name]
+    rnd = random.Random(seed)
+    fixture_files = []
+    for i in range(files):
+        contents = synthetic_file(rnd, lines)
+        added = contents.splitlines()[lines - changed:]
+        start = lines - changed + 1
+        patch = f"@@ -{start - 1},0 +{start},{changed} @@\n" + "\n".join(f"+{line}" for line in added)
+        fixture_files.append({
+            "filename": f"src/module_{i}.py",
+            "status": "modified",
+            "sha": hashlib.sha1(contents.encode("utf-8")).hexdigest(),
+            "patch": patch,
+            "contents": contents,
+        })
+    return {
+        "repository": "octo/bench",
+        "pull_request": {"number": 1, "title": f"Benchmark {name} PR", "body": "Synthetic changes",
+                         "head_sha": hashlib.sha1(name.encode("utf-8")).hexdigest()},
+        "files": fixture_files,
+        "completions": {
+            "issues": [{"severity": 1, "line": lines, "body": "Consider a clearer name"}],
+            "comments": "- Line 1: consider a clearer name.\n- The function could return early.",
+        },
+    }
+
+
+def review(fixture, args) -> dict:
+    '''Review the fixture's PR once against fresh fake servers, returning the measurements'''
+    github = FakeGithub(fixture, latency=args.github_latency, seed=args.seed)
+    openai_server = FakeOpenAI(fixture, latency=args.openai_latency, rate_429=args.openai_429, seed=args.seed)
+    with github, openai_server:
+        os.environ.update(GITHUB_TOKEN="fake", GITHUB_API_URL=github.url,
+                          OPENAI_API_KEY="fake", OPENAI_API_BASE=f"{openai_server.url}/v1")
+        os.environ.pop("GITHUB_REPOSITORY", None)
+        os.environ.pop("GITHUB_STEP_SUMMARY", None)
+        # imported once the fake servers are up, as openai reads its base URL on import
+        import openai
+        import completion
+        import githubs
+        openai.api_base = os.environ["OPENAI_API_BASE"]
+        openai_client = completion.OpenAIClient(args.model, 0.2, 0, 0)
+        github_client = githubs.GithubClient(openai_client, max_workers=args.max_workers,
+                                             async_transport=args.async_transport,
+                                             context_tokens=args.context_tokens)
+        pr = fixture["pull_request"]
+        payload = {"action": "opened", "number": pr["number"],
+                   "pull_request": {"number": pr["number"], "head": {"sha": pr["head_sha"]}},
+                   "repository": {"full_name": fixture["repository"]}}
+        output = io.StringIO()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(output if not args.verbose else sys.stdout):
+            github_client.review_pr(payload)
+        wall = time.perf_counter() - start
+
+    report = github_client.metrics.report()
+    return {
+        "wall_seconds": wall,
+        "files": len(fixture["files"]),
+        "github_api_calls": report["counters"].get("github_api_calls", 0),
+        "github_requests": dict(github.requests),
+        "openai_requests": dict(openai_server.requests),
+        "retries": report["counters"].get("retries", 0),
+        "tokenization_seconds": report["stages"].get("tokenization", {}).get("seconds", 0),
+        "prompt_tokens": report["counters"].get("prompt_tokens", 0),
+        "comments_posted": len(github.comments),
+        "reviews_posted": len(github.reviews),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark review_pr end to end against fake servers')
+    parser.add_argument("--scenario", nargs="+", choices=list(SCENARIOS), default=["small", "medium"])
+    parser.add_argument("--fixture", help="Recorded PR fixture to replay instead of the scenarios")
+    parser.add_argument("--model", default="gpt-4")
+    parser.add_argument("--max-workers", type=int, default=1)
+    parser.add_argument("--async-transport", action="store_true")
+    parser.add_argument("--context-tokens", type=int, default=0,
+                        help="Review only the changed parts of files within this budget, 0 for whole files")
+    parser.add_argument("--github-latency", type=float, default=0, help="Seconds added to each GitHub request")
+    parser.add_argument("--openai-latency", type=float, default=0, help="Seconds added to each OpenAI request")
+    parser.add_argument("--openai-429", type=float, default=0, help="Share of OpenAI requests answered with a 429")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Write the measurements as JSON to this path")
+    parser.add_argument("--verbose", action="store_true", help="Show the reviewer's output")
+    args = parser.parse_args()
+    sys.path.insert(0, APP)
+
+    if args.fixture:
+        with open(args.fixture, encoding="utf-8") as f:
+            fixtures = {os.path.basename(args.fixture): json.load(f)}
+    else:
+        fixtures = {name: synthetic_fixture(name, args.seed) for name in args.scenario}
+
+    results = {}
+    for name, fixture in fixtures.items():
+        runs = [review(fixture, args) for _ in range(args.repeat)]
+        results[name] = min(runs, key=lambda run: run["wall_seconds"])
+
+    print(f"{'scenario':<12} {'files':>6} {'wall s':>8} {'gh calls':>9} {'openai':>7} {'429s':>5} "
+          f"{'retries':>8} {'tokenize s':>11} {'prompt tok':>11}")
+    for name, result in results.items():
+        openai_requests = sum(count for route, count in result["openai_requests"].items() if route != "429")
+        print(f"{name:<12} {result['files']:>6} {result['wall_seconds']:>8.2f} {result['github_api_calls']:>9} "
+              f"{openai_requests:>7} {result['openai_requests'].get('429', 0):>5} {result['retries']:>8} "
+              f"{result['tokenization_seconds']:>11.3f} {result['prompt_tokens']:>11}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Micro-benchmark for Chunker.split_patch on synthetic patches.
+#
+#   python benchmarks/split_patch.py --lines 10000 100000 --budget 7936
+#
+import argparse
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import tiktoken  # noqa: E402
+from budget import TokenBudget  # noqa: E402
+from chunking import Chunker  # noqa: E402
+
+
+def synthetic_patch(lines, hunk_size=40, seed=0) -> str:
+    '''Generate a unified diff body with a hunk header every hunk_size lines'''
+    rnd = random.Random(seed)
+    out = []
+    for i in range(lines):
+        if i % hunk_size == 0:
+            out.append(f"@@ -{i + 1},{hunk_size} +{i + 1},{hunk_size} @@")
+        word = ''.join(rnd.choices(string.ascii_lowercase, k=rnd.randint(3, 12)))
+        out.append(f"{rnd.choice('+- ')}    {word} = {word}_{i}({rnd.randint(0, 1 << 16)})")
+    return '\n'.join(out)
+
+
+def quadratic_cut(encoder, budget, text) -> str:
+    '''The previous implementation: drop one line and re-encode the prefix'''
+    lines = text.splitlines()
+    i = len(lines)
+    while i > 0:
+        i -= 1
+        line = '\n'.join(lines[:i])
+        if len(encoder.encode(line)) < budget:
+            return line
+    return ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark patch chunking')
+    parser.add_argument("--lines", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--budget", type=int, default=8192 - 256)
+    parser.add_argument("--encoding", type=str, default="cl100k_base")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", action="store_true",
+                        help="Also time the former quadratic truncation (slow above a few thousand lines)")
+    args = parser.parse_args()
+
+    encoder = tiktoken.get_encoding(args.encoding)
+    chunker = Chunker(TokenBudget(encoder, args.budget))
+    for n in args.lines:
+        patch = synthetic_patch(n)
+        best = float("inf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            chunks = chunker.split_patch(patch, args.budget)
+            best = min(best, time.perf_counter() - start)
+        print(f"{n:>8} lines: {best * 1000:9.1f} ms, {len(chunks)} chunks, "
+              f"largest {max(chunk.tokens for chunk in chunks)} tokens")
+        if args.baseline:
+            start = time.perf_counter()
+            quadratic_cut(encoder, args.budget, patch)
+            print(f"{'':>8}  quadratic: {(time.perf_counter() - start) * 1000:9.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Cold-start benchmark: how long the action takes before it can review.
+#
+#   python benchmarks/startup.py --repeat 5
+#
+# Each stage runs in a fresh interpreter. The tokenizer is timed both with
+# an empty TIKTOKEN_CACHE_DIR (download) and with a warm one (baked image).
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+
+STAGES = {
+    "interpreter": "pass",
+    "event dispatch": "import events",
+    "clients import": "import cache, completion, githubs",
+    "tokenizer": "import completion; completion.OpenAIClient('gpt-4', 0.2, 0, 0).encoder",
+}
+
+
+def run(code, env) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], cwd=APP, env=env, check=True)
+    return time.perf_counter() - start
+
+
+def run_main(event, env) -> float:
+    '''Time main.py end to end on an event it skips'''
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump(event, f)
+    try:
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "main.py"], cwd=APP, check=True, stdout=subprocess.DEVNULL,
+                       env=dict(env, GITHUB_EVENT_PATH=f.name))
+        return time.perf_counter() - start
+    finally:
+        os.unlink(f.name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark action cold start')
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    env = dict(os.environ, GITHUB_TOKEN="x", OPENAI_API_KEY="x")
+    results = {}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for name, code in STAGES.items():
+            results[name] = min(run(code, env) for _ in range(args.repeat))
+        cold = []
+        for _ in range(args.repeat):
+            with tempfile.TemporaryDirectory() as empty:
+                cold.append(run(STAGES["tokenizer"], dict(env, TIKTOKEN_CACHE_DIR=empty)))
+        results["tokenizer (cold cache)"] = min(cold)
+        warm_env = dict(env, TIKTOKEN_CACHE_DIR=cache_dir)
+        run(STAGES["tokenizer"], warm_env)
+        results["tokenizer (warm cache)"] = min(run(STAGES["tokenizer"], warm_env) for _ in range(args.repeat))
+    results["main.py on a push event"] = min(run_main({"head_commit": {}}, env) for _ in range(args.repeat))
+
+    for name, seconds in results.items():
+        print(f"{name:<26} {seconds * 1000:9.1f} ms")
+
+
+if __name__ == "__main__":
+    main()